@@ -2,26 +2,52 @@
 import argparse
 import sys
 import os
-import math
 import time
 import threading
 import queue
 import bz2
 import shutil
+import collections
+import heapq
+import concurrent.futures
+import asyncio
 import pyinotify
 import ftplib
+import contextlib
+import functools
+import sqlite3
+import hashlib
 import traceback
+import subprocess
+import signal
+import random
+import math
+import json
+import http.server
 from io import BytesIO
 from urllib.parse import urlparse
+from fastdl_common import (USER, PASSWORD, FTP_TRANSIENT_ERRORS, FTP_HEALTHCHECK_INTERVAL, FTP_MAX_RETRY_DELAY,
+	FileHash, Variants, PartName, FTP_FileSize, RemoteIndex, FTPPool, PruneDirs, FTP_RemoveDir, FTP_MakeDirs, FTP_MoveDir,
+	ArtifactCache, Mirror)
 
 global args
 global parsed
 global commonprefix
 global commonprefix_ftp
 global jobs
-
-USER = "****"
-PASSWORD = "****"
+global ready
+global journal
+global levels
+global metrics
+global pending
+global reconciler
+global block_pool
+global cpu
+global bandwidth
+global manifest
+global remote
+global mirrors
+global cache
 
 # Terminal color codes
 c_null	= "\x1b[00;00m"
@@ -52,172 +78,1676 @@ ignore_names = ["cs_assault.bsp", "cs_compound.bsp", "cs_havana.bsp",
 # inotify mask
 NOTIFY_MASK = pyinotify.IN_CLOSE_WRITE | pyinotify.IN_DELETE | pyinotify.IN_MOVED_TO | pyinotify.IN_MOVED_FROM
 
-def static_var(varname, value):
-	def decorate(func):
-		setattr(func, varname, value)
-		return func
-	return decorate
+# Jobs the startup scan would queue again
+COMPRESS_JOBS = ("Compress", "CompressMirrors")
+
+# bzip2 block size at compresslevel 9
+BZ2_BLOCK_SIZE = 900*1000
+
+# Histogram bucket bounds per metric
+METRIC_BUCKETS = {
+	"compress_mbps": (1, 2, 5, 10, 20, 50, 100, 200),
+	"upload_mbps": (0.5, 1, 2, 5, 10, 20, 50, 100),
+	"compression_ratio": (0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0),
+	"publish_latency_seconds": (0.5, 1, 2, 5, 10, 30, 60, 300, 900),
+}
+
+class Metrics:
+	def __init__(self):
+		self.Lock = threading.Lock()
+		self.Start = time.monotonic()
+		self.Counters = collections.Counter()
+		self.Gauges = {}
+		self.Histograms = {} # name -> [bucket counts, count, sum]
+		self.EventTimes = {} # destination path -> time of first unpublished event
+		self.LastReport = self.Start
+
+	def Count(self, name, value=1):
+		with self.Lock:
+			self.Counters[name] += value
+
+	def Set(self, name, value):
+		with self.Lock:
+			self.Gauges[name] = value
+
+	def Observe(self, name, value):
+		bounds = METRIC_BUCKETS[name]
+		with self.Lock:
+			histogram = self.Histograms.setdefault(name, [[0]*len(bounds), 0, 0])
+			for i, bound in enumerate(bounds):
+				if value <= bound:
+					histogram[0][i] += 1
+			histogram[1] += 1
+			histogram[2] += value
+
+	def Mean(self, name):
+		histogram = self.Histograms.get(name)
+		if not histogram or not histogram[1]:
+			return 0
+		return histogram[2]/histogram[1]
+
+	def EventSeen(self, path):
+		with self.Lock:
+			self.EventTimes.setdefault(path, time.monotonic())
+
+	def Forget(self, path):
+		with self.Lock:
+			self.EventTimes.pop(path, None)
+
+	def Published(self, path):
+		with self.Lock:
+			seen = self.EventTimes.pop(path, None)
+		if seen is not None:
+			self.Observe("publish_latency_seconds", time.monotonic() - seen)
+
+	def Snapshot(self):
+		self.Set("queue_depth", jobs.qsize())
+		if ready:
+			self.Set("ready_depth", ready.qsize())
+		with self.Lock:
+			return {
+				"uptime_seconds": time.monotonic() - self.Start,
+				"counters": dict(self.Counters),
+				"gauges": dict(self.Gauges),
+				"histograms": dict((name, {"buckets": dict(zip(METRIC_BUCKETS[name], h[0])), "count": h[1], "sum": h[2]}) for name, h in self.Histograms.items()),
+			}
+
+	def Prometheus(self):
+		snapshot = self.Snapshot()
+		lines = []
+		for name, value in sorted(snapshot["counters"].items()):
+			lines.append("# TYPE fastdl_{0}_total counter".format(name))
+			lines.append("fastdl_{0}_total {1}".format(name, value))
+		for name, value in sorted(snapshot["gauges"].items()):
+			lines.append("# TYPE fastdl_{0} gauge".format(name))
+			lines.append("fastdl_{0} {1}".format(name, value))
+		for name, histogram in sorted(snapshot["histograms"].items()):
+			lines.append("# TYPE fastdl_{0} histogram".format(name))
+			for bound, count in histogram["buckets"].items():
+				lines.append("fastdl_{0}_bucket{{le=\"{1}\"}} {2}".format(name, bound, count))
+			lines.append("fastdl_{0}_bucket{{le=\"+Inf\"}} {1}".format(name, histogram["count"]))
+			lines.append("fastdl_{0}_count {1}".format(name, histogram["count"]))
+			lines.append("fastdl_{0}_sum {1}".format(name, histogram["sum"]))
+		return "\n".join(lines) + "\n"
+
+	def Summary(self):
+		with self.Lock:
+			counters = dict(self.Counters)
+			text = "[stats] queue {0} | scanned {1} | compressed {2} ({3:.1f} MB, {4:.1f} MB/s, ratio {5:.2f})".format(
+				jobs.qsize(), counters.get("scanned_files", 0), counters.get("compressed_files", 0),
+				counters.get("compressed_bytes_in", 0)/1024/1024, self.Mean("compress_mbps"),
+				counters.get("compressed_bytes_out", 0)/max(counters.get("compressed_bytes_in", 0), 1))
+			text += " | uploaded {0} ({1:.1f} MB/s)".format(counters.get("uploaded_files", 0), self.Mean("upload_mbps"))
+			if counters.get("raw_files"):
+				text += " | raw {0} ({1:.0f}s CPU saved, {2:.1f} MB extra sent)".format(counters["raw_files"], counters.get("raw_cpu_seconds_saved", 0), counters.get("raw_extra_bytes", 0)/1024/1024)
+			if counters.get("retries"):
+				text += " | retries {0} ({1} resumed, {2:.1f} MB not resent)".format(counters["retries"], counters.get("resumed_uploads", 0), counters.get("resumed_bytes", 0)/1024/1024)
+			if counters.get("cpu_throttle_seconds") or counters.get("bandwidth_throttle_seconds"):
+				text += " | throttled {0:.0f}s cpu, {1:.0f}s net".format(counters.get("cpu_throttle_seconds", 0), counters.get("bandwidth_throttle_seconds", 0))
+			text += " | latency {0:.1f}s | errors {1}".format(self.Mean("publish_latency_seconds"), counters.get("errors", 0))
+		return text
+
+	def Tick(self):
+		# Called from the main loop, reports every --stats-interval seconds
+		now = time.monotonic()
+		if now - self.LastReport < args.stats_interval:
+			return
+		self.LastReport = now
+
+		print(self.Summary())
+		if args.stats_file:
+			temp = args.stats_file + ".tmp"
+			with open(temp, "w") as f:
+				json.dump(self.Snapshot(), f, indent=1)
+			os.replace(temp, args.stats_file)
+
+	def Serve(self, address, port):
+		metrics = self
+		class Handler(http.server.BaseHTTPRequestHandler):
+			def do_GET(self):
+				body = metrics.Prometheus().encode()
+				self.send_response(200)
+				self.send_header("Content-Type", "text/plain; version=0.0.4")
+				self.send_header("Content-Length", str(len(body)))
+				self.end_headers()
+				self.wfile.write(body)
+
+			def log_message(self, format, *args):
+				pass
+
+		server = http.server.ThreadingHTTPServer((address, port), Handler)
+		thread = threading.Thread(target=server.serve_forever)
+		thread.daemon = True
+		thread.start()
+
+# Remembers size, mtime and content hash of every source file we compressed,
+# so startup only has to stat a file to know whether it changed, and the size
+# it was published with, so verify mode can spot broken uploads.
+class Manifest:
+	def __init__(self, path, readonly=False):
+		self.ReadOnly = readonly # dry runs keep changes in memory only
+		self.Lock = threading.Lock()
+		self.Database = sqlite3.connect(path, check_same_thread=False)
+		self.Database.execute("PRAGMA journal_mode=WAL")
+		self.Database.execute("PRAGMA synchronous=NORMAL")
+		self.Database.execute("CREATE TABLE IF NOT EXISTS files (destfile TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, hash TEXT, published INTEGER)")
+		self.Database.execute("CREATE TABLE IF NOT EXISTS uploads (path TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, level INTEGER)")
+		if "published" not in [column[1] for column in self.Database.execute("PRAGMA table_info(files)")]:
+			# Manifest from an older version
+			self.Database.execute("ALTER TABLE files ADD COLUMN published INTEGER")
+		self.Database.commit()
+
+		# Everything is kept in memory, the database is only written through
+		self.Entries = {}
+		for destfile, size, mtime, digest, published in self.Database.execute("SELECT destfile, size, mtime, hash, published FROM files"):
+			self.Entries[destfile] = (size, mtime, digest, published)
+
+	def Lookup(self, destfile):
+		return self.Entries.get(destfile)
+
+	def Unchanged(self, sourcefile, destfile, stat=None):
+		entry = self.Entries.get(destfile)
+		if entry is None:
+			return False
+
+		if stat is None:
+			stat = os.stat(sourcefile)
+		size, mtime, digest, published = entry
+		if size != stat.st_size:
+			return False
+		if mtime == stat.st_mtime_ns:
+			return True
+
+		# Touched but maybe not modified, compare content
+		if digest is not None and digest == FileHash(sourcefile):
+			self.Update(destfile, stat.st_size, stat.st_mtime_ns, digest, published)
+			return True
+		return False
+
+	def Update(self, destfile, size, mtime, digest, published=None):
+		# published is the size of the remote file, None when unknown
+		with self.Lock:
+			self.Entries[destfile] = (size, mtime, digest, published)
+			self.Write("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)", (destfile, size, mtime, digest, published))
+
+	def Remove(self, path):
+		# path may be a file or a whole directory
+		prefix = path.rstrip("/") + "/"
+		with self.Lock:
+			for destfile in [f for f in self.Entries if f == path or f.startswith(prefix)]:
+				del self.Entries[destfile]
+			self.Write("DELETE FROM files WHERE destfile = ? OR substr(destfile, 1, ?) = ?", (path, len(prefix), prefix))
+
+	def Below(self, path):
+		prefix = path.rstrip("/") + "/"
+		with self.Lock:
+			return [f for f in self.Entries if f.startswith(prefix)]
+
+	def Move(self, sourcepath, destpath):
+		prefix = sourcepath.rstrip("/") + "/"
+		with self.Lock:
+			for destfile in [f for f in self.Entries if f == sourcepath or f.startswith(prefix)]:
+				self.Entries[destpath + destfile[len(sourcepath):]] = self.Entries.pop(destfile)
+			self.Write("UPDATE OR REPLACE files SET destfile = ? || substr(destfile, ?) WHERE destfile = ? OR substr(destfile, 1, ?) = ?",
+				(destpath, len(sourcepath) + 1, sourcepath, len(prefix), prefix))
+
+	# Unfinished uploads, remembered with the source they were made from
+	# so a partial remote file is only resumed for the same content
+	def Partial(self, path):
+		with self.Lock:
+			return self.Database.execute("SELECT size, mtime, level FROM uploads WHERE path = ?", (path,)).fetchone()
+
+	def StartUpload(self, path, size, mtime, level):
+		with self.Lock:
+			self.Write("INSERT OR REPLACE INTO uploads VALUES (?, ?, ?, ?)", (path, size, mtime, level))
+
+	def FinishUpload(self, path):
+		with self.Lock:
+			self.Write("DELETE FROM uploads WHERE path = ?", (path,))
+
+	def Write(self, sql, params):
+		# Called with the lock held
+		if not self.ReadOnly:
+			self.Database.execute(sql, params)
+			self.Database.commit()
+
+	def Close(self):
+		with self.Lock:
+			self.Database.close()
+
+# Write-ahead log of the job queue, kept next to the manifest. Jobs are written
+# before they are queued and removed when done, whatever is left at startup
+# (crash, kill or checkpoint) is queued again. Every row carries the
+# destination it was written for, daemons sharing a manifest only replay their own.
+class Journal:
+	def __init__(self, path, destination):
+		self.Destination = destination
+		self.Lock = threading.Lock()
+		self.Database = sqlite3.connect(path, check_same_thread=False)
+		self.Database.execute("PRAGMA journal_mode=WAL")
+		self.Database.execute("PRAGMA synchronous=NORMAL")
+		self.Database.execute("CREATE TABLE IF NOT EXISTS journal (id INTEGER PRIMARY KEY, job TEXT, destination TEXT)")
+		if "destination" not in [column[1] for column in self.Database.execute("PRAGMA table_info(journal)")]:
+			# Journal from an older version, its rows go to the first daemon that starts
+			self.Database.execute("ALTER TABLE journal ADD COLUMN destination TEXT")
+		self.Database.execute("UPDATE journal SET destination = ? WHERE destination IS NULL", (destination,))
+		self.Database.commit()
+
+		self.Rows = {} # id(job) -> row, while the job is queued or running
+		self.Replayed = set() # destinations of replayed compress jobs, the startup scan leaves them alone
+
+	def Add(self, job):
+		data = json.dumps([job[0].__name__] + list(job[1:]))
+		with self.Lock:
+			self.Rows[id(job)] = self.Database.execute("INSERT INTO journal (job, destination) VALUES (?, ?)", (data, self.Destination)).lastrowid
+			self.Database.commit()
+
+	def Done(self, job):
+		with self.Lock:
+			row = self.Rows.pop(id(job), None)
+			if row is not None:
+				self.Database.execute("DELETE FROM journal WHERE id = ?", (row,))
+				self.Database.commit()
+
+	def Load(self):
+		loaded = []
+		with self.Lock:
+			for row, data in self.Database.execute("SELECT id, job FROM journal WHERE destination = ? ORDER BY id", (self.Destination,)).fetchall():
+				name, *params = json.loads(data)
+				job = (globals()[name],) + tuple(tuple(p) if isinstance(p, list) else p for p in params)
+				if name in COMPRESS_JOBS:
+					self.Replayed.add(job[-1])
+				self.Rows[id(job)] = row
+				loaded.append(job)
+		return loaded
+
+	def Count(self):
+		with self.Lock:
+			return self.Database.execute("SELECT COUNT(*) FROM journal WHERE destination = ?", (self.Destination,)).fetchone()[0]
+
+	def Close(self):
+		with self.Lock:
+			self.Database.close()
 
 def PrettyPrint(filename, status):
+	if args.quiet:
+		return
+
 	if status == "Exists":
 		color = c_white
-	elif status == "Added":
+	elif status == "Added" or status == "Changed":
 		color = c_orange
-	elif status == "Done" or status == "Moved":
+	elif status == "Done" or status == "Moved" or status == "Raw":
 		color = c_green
 	else:
 		color = c_red
 
-	columns = int(os.popen("stty size", 'r').read().split()[1])
-	rows = math.ceil((len(filename) + len(status))/columns)
+	# ioctl instead of forking stty per file, falls back to 80 columns without a TTY
+	columns = shutil.get_terminal_size().columns
+	rows = -(-(len(filename) + len(status))//columns)
 	text = filename + '.'*(columns*rows - (len(filename) + len(status))) + color + status + c_null
 	text += chr(8)*(len(text) + 1)
 	print(text + '\n'*rows)
 
 
-# This is called a lot during startup.
-@static_var("cache_path", 0)
-@static_var("cache_resp", 0)
-@static_var("cache_ftp", 0)
-def FTP_FileExists(ftp, path):
-	Exists = False
-	try:
-		# Cache should only be valid for one ftp connection
-		if FTP_FileExists.cache_ftp != ftp:
-			FTP_FileExists.cache_ftp = ftp
-			FTP_FileExists.cache_path = 0
-			FTP_FileExists.cache_resp = 0
-
-		if FTP_FileExists.cache_path  != os.path.dirname(path):
-			FTP_FileExists.cache_path = os.path.dirname(path)
-			FTP_FileExists.cache_resp = []
-			ftp.dir(os.path.dirname(path), FTP_FileExists.cache_resp.append)
-
-		for line in FTP_FileExists.cache_resp:
-			if line[0] == '-':
-				line = line.split(maxsplit=8)[8]
-				if line == os.path.basename(path):
-					Exists = True
+# Limits how many threads compress at the same time and holds compression
+# back while the load average is above max_load, so the game servers on
+# the same box keep their tick rate.
+class CPUBudget:
+	def __init__(self, slots, max_load):
+		self.Slots = threading.BoundedSemaphore(slots)
+		self.MaxLoad = max_load
+
+	@contextlib.contextmanager
+	def Slot(self):
+		start = time.perf_counter()
+		while self.MaxLoad and os.getloadavg()[0] > self.MaxLoad:
+			time.sleep(1)
+		self.Slots.acquire()
+		waited = time.perf_counter() - start
+		if waited > 0.001:
+			metrics.Count("cpu_throttle_seconds", waited)
+		try:
+			yield
+		finally:
+			self.Slots.release()
+
+def LowerPriority(nice, idle_io):
+	# Called before any thread is started, new threads inherit both
+	if nice:
+		os.nice(nice)
+	if idle_io:
+		try:
+			subprocess.run(["ionice", "-c", "3", "-p", str(os.getpid())], check=True)
+		except (OSError, subprocess.CalledProcessError):
+			print("Couldn't set idle I/O priority, is ionice installed?")
+
+# Token bucket shared by everything that uploads. Callers take what they
+# need and sleep off the debt, so concurrent uploads get a fair share.
+class TokenBucket:
+	def __init__(self, rate):
+		self.Rate = rate # bytes per second, None for unlimited
+		self.Burst = max(rate or 0, 64*1024)
+		self.Tokens = self.Burst
+		self.Last = time.monotonic()
+		self.Lock = threading.Lock()
+
+	def Reserve(self, size):
+		# Takes size tokens, returns how long the caller has to wait for them
+		if not self.Rate:
+			return 0
+		with self.Lock:
+			now = time.monotonic()
+			self.Tokens = min(self.Burst, self.Tokens + (now - self.Last)*self.Rate)
+			self.Last = now
+			self.Tokens -= size
+			wait = -self.Tokens/self.Rate if self.Tokens < 0 else 0
+		if wait:
+			metrics.Count("bandwidth_throttle_seconds", wait)
+		return wait
+
+	def Consume(self, size):
+		wait = self.Reserve(size)
+		if wait:
+			time.sleep(wait)
+
+# File-like wrapper for storbinary that draws from the bandwidth bucket
+class Throttled:
+	def __init__(self, fileobj):
+		self.File = fileobj
+
+	def read(self, size=-1):
+		data = self.File.read(size)
+		bandwidth.Consume(len(data))
+		return data
+
+def TimedCompress(block, level):
+	with cpu.Slot():
+		start = time.perf_counter()
+		data = bz2.compress(block, level)
+	return data, time.perf_counter() - start
+
+# pbzip2 style: every block becomes its own bz2 stream, compressed in parallel.
+# bzip2 and Python read the concatenated streams as one file, but decoders that
+# stop at the first end of stream only see the first block, hence opt-in.
+def CompressBlocks(infile, digest, level):
+	start = time.perf_counter()
+	size = 0
+	outsize = 0
+	cputime = 0
+	pending = collections.deque()
+	for block in iter(lambda: infile.read(BZ2_BLOCK_SIZE), b""):
+		digest.update(block)
+		size += len(block)
+		pending.append(block_pool.submit(TimedCompress, block, level))
+
+		# Bound memory to a few blocks per compression thread
+		while len(pending) > 2*args.compress_threads:
+			data, elapsed = pending.popleft().result()
+			cputime += elapsed
+			outsize += len(data)
+			yield data
+
+	while pending:
+		data, elapsed = pending.popleft().result()
+		cputime += elapsed
+		outsize += len(data)
+		yield data
+
+	# Sum of per-block times is what the single stream would have taken
+	walltime = time.perf_counter() - start
+	CompressStats(size, outsize, walltime)
+	if not args.quiet:
+		print("Compressed {0} in {1:.1f}s ({2:.1f} MB/s, {3:.1f}x speedup over single stream)".format(os.path.relpath(infile.name, commonprefix), walltime, size/walltime/1024/1024, cputime/walltime))
+
+def CompressStats(size, outsize, elapsed):
+	metrics.Count("compressed_files")
+	metrics.Count("compressed_bytes_in", size)
+	metrics.Count("compressed_bytes_out", outsize)
+	if size:
+		metrics.Observe("compression_ratio", outsize/size)
+	if elapsed > 0:
+		metrics.Observe("compress_mbps", size/elapsed/1024/1024)
+
+def CompressChunks(infile, digest, level=9):
+	if args.parallel_threshold is not None and os.fstat(infile.fileno()).st_size >= args.parallel_threshold*1024*1024:
+		yield from CompressBlocks(infile, digest, level)
+		return
+
+	# Time spent suspended in yield belongs to the consumer, not to compression
+	size = 0
+	outsize = 0
+	elapsed = 0
+	start = time.perf_counter()
+	compressor = bz2.BZ2Compressor(level)
+	for chunk in iter(lambda: infile.read(64*1024), b""):
+		digest.update(chunk)
+		size += len(chunk)
+		with cpu.Slot():
+			data = compressor.compress(chunk)
+		if data:
+			outsize += len(data)
+			elapsed += time.perf_counter() - start
+			yield data
+			start = time.perf_counter()
+
+	data = compressor.flush()
+	outsize += len(data)
+	CompressStats(size, outsize, elapsed + time.perf_counter() - start)
+	yield data
+
+# File-like reader for storbinary, compression runs in its own thread and
+# hands finished chunks over through a bounded queue, so it overlaps with the upload.
+# When resuming, the first offset bytes are produced again but not handed out.
+class CompressedStream:
+	def __init__(self, chunks, tee=None, offset=0, depth=16):
+		self.Tee = tee # optional file that gets a copy of everything, for the mirrors
+		self.Offset = offset
+		self.Queue = queue.Queue(maxsize=depth)
+		self.Buffer = bytearray()
+		self.Size = offset
+		self.Error = None
+		self.Done = False
+		self.Closed = False
+		self.Thread = threading.Thread(target=self.Produce, args=(chunks,))
+		self.Thread.daemon = True
+		self.Thread.start()
+
+	def Produce(self, chunks):
+		skip = self.Offset
+		try:
+			for data in chunks:
+				if self.Closed:
 					break
-	except ftplib.error_perm:
-		pass
+				if self.Tee:
+					self.Tee.write(data)
+				if skip:
+					cut = min(skip, len(data))
+					data = data[cut:]
+					skip -= cut
+					if not data:
+						continue
+				self.Queue.put(data)
+		except Exception as e:
+			self.Error = e
+		finally:
+			self.Queue.put(None)
+
+	def read(self, size=-1):
+		while not self.Done and (size < 0 or len(self.Buffer) < size):
+			data = self.Queue.get()
+			if data is None:
+				self.Done = True
+				if self.Error:
+					raise self.Error
+			else:
+				self.Buffer += data
+
+		if size < 0:
+			size = len(self.Buffer)
+		data = bytes(self.Buffer[:size])
+		del self.Buffer[:size]
+		self.Size += len(data)
+		return data
+
+	def close(self):
+		# Upload may have failed halfway, unblock and stop the producer
+		self.Closed = True
+		while not self.Done:
+			self.Done = self.Queue.get() is None
+		self.Thread.join()
+
+def CompressionLevel(sourcefile):
+	# Extension rules beat directory rules beat the default
+	level = levels.get("default", 9)
+	for part in os.path.dirname(sourcefile).split(os.sep):
+		level = levels.get(part, level)
+	return levels.get(os.path.splitext(sourcefile)[1], level)
+
+def ParseLevels(items):
+	levels = {}
+	for item in items:
+		name, _, value = item.partition("=")
+		levels[name] = int(value)
+	return levels
+
+# Returns (level, compressed data or None). Level 0 means publish the raw file,
+# either because a rule says so or because the sample from the start of the
+# file barely shrinks. Files that fit into the sample are not compressed twice.
+def ChoosePolicy(infile):
+	size = os.fstat(infile.fileno()).st_size
+	level = CompressionLevel(infile.name)
+	if level:
+		sample = infile.read(int(args.sample_size*1024*1024))
+		infile.seek(0)
+		if not sample:
+			return level, None
+
+		start = time.perf_counter()
+		with cpu.Slot():
+			compressed = bz2.compress(sample, level)
+		elapsed = time.perf_counter() - start
+		ratio = len(compressed)/len(sample)
+		if ratio <= args.max_ratio:
+			if len(sample) < size:
+				return level, None
+			CompressStats(size, len(compressed), elapsed)
+			return level, compressed
+
+		# Estimate what compressing the whole file would have cost and saved
+		metrics.Count("raw_cpu_seconds_saved", elapsed*size/len(sample))
+		metrics.Count("raw_extra_bytes", max(0, int(size*(1 - ratio))))
+
+	metrics.Count("raw_files")
+	metrics.Count("raw_bytes", size)
+	return 0, None
+
+def EncodeChunks(infile, digest, level, compressed=None):
+	if not level:
+		for chunk in iter(lambda: infile.read(64*1024), b""):
+			digest.update(chunk)
+			yield chunk
+	elif compressed is not None:
+		digest.update(infile.read())
+		yield compressed
+	else:
+		yield from CompressChunks(infile, digest, level)
 
-	return Exists
+def EncodeFile(sourcefile, outfile):
+	# A source file as it gets published, for the artifact cache. Returns the level.
+	with open(sourcefile, "rb") as infile:
+		level, compressed = ChoosePolicy(infile)
+		for data in EncodeChunks(infile, hashlib.blake2b(digest_size=20), level, compressed):
+			outfile.write(data)
+	return level
+
+def ResumeOffset(ftp, part, stat, level, size=None):
+	# Pick up where a dropped upload of the same source left off, size is
+	# the total when known, a longer part file means start over
+	offset = 0
+	if manifest.Partial(part) == (stat.st_size, stat.st_mtime_ns, level):
+		offset = FTP_FileSize(ftp, part) or 0
+	else:
+		manifest.StartUpload(part, stat.st_size, stat.st_mtime_ns, level)
+	if size is not None and offset > size:
+		offset = 0
+	if offset:
+		metrics.Count("resumed_uploads")
+		metrics.Count("resumed_bytes", offset)
+	return offset
+
+def StorePart(ftp, part, reader, offset):
+	# Returns the seconds the transfer took
+	start = time.perf_counter()
+	if offset:
+		ftp.storbinary("APPE {0}".format(part), Throttled(reader), 64*1024)
+	else:
+		ftp.storbinary("STOR {0}".format(part), Throttled(reader), 64*1024)
+	return time.perf_counter() - start
+
+def PublishPart(ftp, part, target, destfile, size):
+	# Only publish what the server actually got
+	remotesize = FTP_FileSize(ftp, part)
+	if remotesize != size:
+		manifest.FinishUpload(part) # start over on retry
+		raise ftplib.error_temp("451 {0}: sent {1} bytes, server has {2}".format(part, size, remotesize))
 
-def FTP_DirExists(ftp, path):
-	Exists = False
+	# Renamed over the target, clients get the old file until the new one is in place
 	try:
-		resp = []
-		ftp.dir(os.path.abspath(os.path.join(path, "..")), resp.append)
-		for line in resp:
-			if line[0] == 'd':
-				line = line.split(maxsplit=8)[8]
-				if line == os.path.basename(path):
-					Exists = True
-					break
+		ftp.rename(part, target)
 	except ftplib.error_perm:
-		pass
-
-	return Exists
+		if not remote.FileExists(target):
+			raise
+		# Server refuses to rename onto an existing file
+		ftp.delete(target)
+		ftp.rename(part, target)
+	manifest.FinishUpload(part)
+	remote.AddFile(target, size)
+
+	# Drop the other form (raw vs compressed) if the policy changed
+	for path in Variants(destfile):
+		if path != target and remote.FileExists(path):
+			ftp.delete(path)
+			remote.Remove(path)
+
+def UploadStats(sent, elapsed):
+	metrics.Count("uploaded_files")
+	metrics.Count("uploaded_bytes", sent)
+	if elapsed > 0:
+		metrics.Observe("upload_mbps", sent/elapsed/1024/1024)
 
 def Compress(ftp, item):
 	sourcefile, destfile = item
-	# Remove destination file if already exists
-	if FTP_FileExists(ftp, destfile):
-		ftp.delete(destfile)
 
-	# Check whether directory tree exists at destination, create it if necessary
-	directory = os.path.dirname(destfile)
-	if not FTP_DirExists(ftp, directory):
-		ftp.mkd(directory)
+	# Stream compressed data straight into the data connection, no temp file.
+	# With mirrors a copy goes to the artifact cache, so they don't compress again.
+	digest = hashlib.blake2b(digest_size=20)
+	tee = cache.Temp() if mirrors else None
+	try:
+		with open(sourcefile, "rb") as infile:
+			stat = os.fstat(infile.fileno())
+			level, compressed = ChoosePolicy(infile)
+			target = destfile if level else destfile[:-4] # Source clients fall back to the raw file
+			part = PartName(target)
+
+			# Create the missing part of the directory tree at destination
+			FTP_MakeDirs(ftp, remote, os.path.dirname(destfile))
+
+			# Compression is deterministic, so when resuming the output is
+			# regenerated and only the part the server doesn't have gets sent
+			offset = ResumeOffset(ftp, part, stat, level)
+			stream = CompressedStream(EncodeChunks(infile, digest, level, compressed), tee, offset)
+			try:
+				elapsed = StorePart(ftp, part, stream, offset)
+			finally:
+				stream.close()
+
+		PublishPart(ftp, part, target, destfile, stream.Size)
+	except:
+		if tee:
+			tee.close()
+			os.remove(tee.name)
+		raise
+
+	UploadStats(stream.Size - offset, elapsed)
+	manifest.Update(destfile, stat.st_size, stat.st_mtime_ns, digest.hexdigest(), stream.Size)
+
+	if tee:
+		tee.close()
+		artifact = cache.Store(tee.name, digest.hexdigest(), len(mirrors), CompressionLevel(sourcefile), level)
+		for mirror in mirrors:
+			mirror.Put(mirror.Publish, artifact, os.path.relpath(target, parsed.path))
+
+	PrettyPrint(os.path.relpath(sourcefile, commonprefix), "Done" if level else "Raw")
+
+# Pipeline mode, CPU stage. Compresses into the artifact cache and leaves the
+# transfer to the upload stage, so compression and uploads overlap and each
+# stage has its own thread count.
+def Prepare(item):
+	sourcefile, destfile = item
+	digest = hashlib.blake2b(digest_size=20)
+	with cache.Temp() as temp:
+		try:
+			with open(sourcefile, "rb") as infile:
+				stat = os.fstat(infile.fileno())
+				level, compressed = ChoosePolicy(infile)
+				for data in EncodeChunks(infile, digest, level, compressed):
+					temp.write(data)
+		except:
+			temp.close()
+			os.remove(temp.name)
+			raise
+	return temp.name, digest.hexdigest(), level, stat
+
+# Pipeline mode, I/O stage. The artifact is on local disk, so resuming is a seek.
+def Upload(ftp, item, artifact):
+	target, part, size, offset = PrepareUpload(ftp, item, artifact)
+	with open(artifact[0], "rb") as infile:
+		infile.seek(offset)
+		elapsed = StorePart(ftp, part, infile, offset)
+	CompleteUpload(ftp, item, artifact, target, part, size, offset, elapsed)
+
+# Everything around the transfer, shared with the asyncio engine.
+# Returns (target, part, size, offset).
+def PrepareUpload(ftp, item, artifact):
+	sourcefile, destfile = item
+	tempname, digest, level, stat = artifact
+	target = destfile if level else destfile[:-4] # Source clients fall back to the raw file
+	part = PartName(target)
+	size = os.path.getsize(tempname)
+
+	FTP_MakeDirs(ftp, remote, os.path.dirname(destfile))
+	return target, part, size, ResumeOffset(ftp, part, stat, level, size)
 
-	tempfile = os.path.join("/tmp", os.path.basename(destfile))
+def CompleteUpload(ftp, item, artifact, target, part, size, offset, elapsed):
+	sourcefile, destfile = item
+	tempname, digest, level, stat = artifact
+	PublishPart(ftp, part, target, destfile, size)
 
-	with open(sourcefile, "rb") as infile:
-		with bz2.BZ2File(tempfile, "wb", compresslevel=9) as outfile:
-			shutil.copyfileobj(infile, outfile, 64*1024)
+	UploadStats(size - offset, elapsed)
+	manifest.Update(destfile, stat.st_size, stat.st_mtime_ns, digest, size)
 
-	with open(tempfile, "rb") as temp:
-		ftp.storbinary("STOR {0}".format(destfile), temp)
+	if mirrors:
+		artifact = cache.Store(tempname, digest, len(mirrors), CompressionLevel(sourcefile), level)
+		for mirror in mirrors:
+			mirror.Put(mirror.Publish, artifact, os.path.relpath(target, parsed.path))
+	else:
+		os.remove(tempname)
+
+	PrettyPrint(os.path.relpath(sourcefile, commonprefix), "Done" if level else "Raw")
 
-	os.remove(tempfile)
+def CompressMirrors(ftp, item):
+	# Primary is up to date, publish to the mirrors that lack the file
+	sourcefile, destfile = item
+	relpath = os.path.relpath(destfile, parsed.path)
+	missing = [mirror for mirror in mirrors if not mirror.Exists(relpath)]
+	if not missing:
+		return
 
-	PrettyPrint(os.path.relpath(sourcefile, commonprefix), "Done")
+	artifact, level = cache.Build(sourcefile, len(missing), CompressionLevel(sourcefile))
+	for mirror in missing:
+		mirror.Put(mirror.Publish, artifact, relpath if level else relpath[:-4])
 
 def Delete(ftp, item):
-	item = item[0]
+	DeleteBatch(ftp, ([item[0]],))
+
+def DeleteBatch(ftp, item):
+	# Several deletes on one pooled connection, then one prune of the directories they emptied
+	directories = set()
+	for path in item[0]:
+		manifest.Remove(path)
+
+		if remote.DirExists(path):
+			# Source directory is gone, delete everything published below it
+			targets = [f for f in list(remote.Files) if f.startswith(path + "/")]
+			directories.update(d for d in list(remote.Dirs) if d == path or d.startswith(path + "/"))
+		else:
+			# Only try the raw name if it's actually there
+			targets = [v for v in Variants(path) if v == path or remote.FileExists(v)]
 
-	try:
-		ftp.delete(item)
+		for target in targets:
+			try:
+				ftp.delete(target)
+			except ftplib.error_perm:
+				continue
 
-		PrettyPrint(os.path.relpath(item, commonprefix_ftp), "Deleted")
-	except ftplib.error_perm:
-		pass
+			remote.Remove(target)
+			directories.add(os.path.dirname(target))
+			PrettyPrint(os.path.relpath(target, commonprefix_ftp), "Deleted")
+
+	PruneDirs(directories, parsed.path, functools.partial(FTP_RemoveDir, ftp, remote))
+	for mirror in mirrors:
+		mirror.Put(mirror.DeleteBatch, [os.path.relpath(path, parsed.path) for path in item[0]], [os.path.relpath(d, parsed.path) for d in directories])
 
 def Move(ftp, item):
 	sourcepath, destpath = item
 
-	# Check whether directory tree exists at destination, create it if necessary
-	directory = os.path.dirname(destpath)
-	if not FTP_DirExists(ftp, directory):
-		ftp.mkd(directory)
+	for mirror in mirrors:
+		mirror.Put(mirror.Move, os.path.relpath(sourcepath, parsed.path), os.path.relpath(destpath, parsed.path))
+	manifest.Move(sourcepath, destpath)
+
+	if remote.DirExists(sourcepath):
+		FTP_MoveDir(ftp, remote, sourcepath, destpath)
+	else:
+		if not remote.FileExists(sourcepath) and remote.FileExists(Variants(sourcepath)[-1]):
+			# Published raw
+			sourcepath, destpath = sourcepath[:-4], destpath[:-4]
 
-	ftp.rename(sourcepath, destpath)
+		FTP_MakeDirs(ftp, remote, os.path.dirname(destpath))
+		ftp.rename(sourcepath, destpath)
+		remote.Move(sourcepath, destpath)
 
 	PrettyPrint("{0} -> {1}".format(os.path.relpath(sourcepath, commonprefix_ftp), os.path.relpath(destpath, commonprefix_ftp)), "Moved")
 
 
+# Drop-in replacement for queue.Queue. Deletes and moves go first, then
+# compress jobs by priority class (maps first by default) and smallest file
+# first within a class. Jobs waiting longer than max_wait jump the line.
+class JobScheduler(queue.Queue):
+	def __init__(self, priorities, max_wait):
+		self.Priorities = priorities # extension or directory name -> priority class
+		self.MaxWait = max_wait
+		queue.Queue.__init__(self)
+
+	def put(self, job, block=True, timeout=None):
+		# Written ahead, so queued work survives a crash
+		journal.Add(job)
+		queue.Queue.put(self, job, block, timeout)
+
+	def Replay(self):
+		# Jobs left over from the last run, they are in the journal already
+		replayed = journal.Load()
+		for job in replayed:
+			queue.Queue.put(self, job)
+		return len(replayed)
+
+	def Done(self, job):
+		# Called once per job when it's finished, whoever finished it
+		journal.Done(job)
+		with self.mutex:
+			for path in self.Paths(job):
+				self.Running[path] -= 1
+				if not self.Running[path]:
+					del self.Running[path]
+
+	def Pending(self, path):
+		# A job on path is queued or running
+		with self.mutex:
+			return path in self.Queued or path in self.Running
+
+	def _init(self, maxsize):
+		self.Heap = []
+		self.Arrival = collections.deque()
+		self.Count = 0
+		self.Sequence = 0
+		self.Queued = {} # destination path -> entries not handed out yet
+		self.Below = {} # directory -> paths in Queued anywhere below it
+		self.Running = collections.Counter() # destination path -> jobs handed out, not done yet
+
+	def _qsize(self):
+		return self.Count
+
+	def Priority(self, job):
+		if job[0] is not Compress and job[0] is not CompressMirrors:
+			return 0, 0
+
+		sourcefile = job[1]
+		priority = self.Priorities.get("default", 3)
+		for part in os.path.dirname(sourcefile).split(os.sep):
+			priority = self.Priorities.get(part, priority)
+		priority = self.Priorities.get(os.path.splitext(sourcefile)[1], priority)
+
+		try:
+			size = os.path.getsize(sourcefile)
+		except OSError:
+			size = 0
+		return priority, size
+
+	def Paths(self, job):
+		# Destination paths a job works on
+		if job[0] is DeleteBatch:
+			return job[1]
+		if job[0] is Move:
+			return job[1:3]
+		return job[-1:]
+
+	def Ancestors(self, path):
+		parent = os.path.dirname(path)
+		while parent not in ("", "/"):
+			yield parent
+			parent = os.path.dirname(parent)
+
+	def Conflicts(self, job):
+		# Queued jobs on the same path, a directory above it or, for moves
+		# and deletes, anything below it. Index lookups only, the queue
+		# mutex is held.
+		for path in self.Paths(job):
+			yield from self.Queued.get(path, ())
+			for parent in self.Ancestors(path):
+				yield from self.Queued.get(parent, ())
+			if job[0] is not Compress:
+				for key in self.Below.get(path, ()):
+					yield from self.Queued[key]
+
+	def _put(self, job):
+		# A job never overtakes an earlier one it depends on, it sorts right
+		# behind the last of them instead
+		priority = max([self.Priority(job)] + [entry[0] for entry in self.Conflicts(job)])
+		self.Sequence += 1
+		entry = [priority, self.Sequence, job, time.monotonic(), False]
+		heapq.heappush(self.Heap, entry)
+		self.Arrival.append(entry)
+		for path in self.Paths(job):
+			if path not in self.Queued:
+				self.Queued[path] = []
+				for parent in self.Ancestors(path):
+					self.Below.setdefault(parent, set()).add(path)
+			self.Queued[path].append(entry)
+		self.Count += 1
+
+	def _get(self):
+		# Drop entries already handed out through the other structure
+		while self.Arrival[0][4]:
+			self.Arrival.popleft()
+		while self.Heap[0][4]:
+			heapq.heappop(self.Heap)
+
+		# Starvation protection
+		if time.monotonic() - self.Arrival[0][3] > self.MaxWait:
+			entry = self.Arrival.popleft()
+		else:
+			entry = heapq.heappop(self.Heap)
+
+		entry[4] = True
+		self.Count -= 1
+		for path in self.Paths(entry[2]):
+			self.Running[path] += 1
+			self.Queued[path].remove(entry)
+			if not self.Queued[path]:
+				del self.Queued[path]
+				for parent in self.Ancestors(path):
+					self.Below[parent].discard(path)
+					if not self.Below[parent]:
+						del self.Below[parent]
+		return entry[2]
+
+def ParsePriorities(items):
+	# Deletes and moves are always class 0
+	priorities = {".bsp": 1, "default": 3}
+	for item in items:
+		name, _, value = item.partition("=")
+		priorities[name] = int(value)
+	return priorities
+
+# Walks all source trees in parallel with os.scandir, every directory is a
+# separate task. Yields (handler, dirpath, filename, stat) as soon as a
+# directory has been read, so jobs reach the workers while the scan goes on.
+# roots limits the walk to (handler, directory) subtrees.
+def ScanSources(handlers, threads, roots=None):
+	results = queue.Queue()
+	lock = threading.Lock()
+	outstanding = [0]
+	executor = concurrent.futures.ThreadPoolExecutor(max_workers=threads)
+
+	def Submit(handler, path):
+		with lock:
+			outstanding[0] += 1
+		executor.submit(ScanDirectory, handler, path)
+
+	def ScanDirectory(handler, path):
+		candidates = []
+		try:
+			with os.scandir(path) as entries:
+				for entry in entries:
+					try:
+						if entry.is_dir(follow_symlinks=False):
+							Submit(handler, entry.path)
+						elif entry.name.endswith(valid_extensions) and entry.name not in ignore_names:
+							candidates.append((entry.name, entry.stat()))
+					except FileNotFoundError:
+						pass # removed between readdir and stat
+					except OSError as e:
+						# Only this entry, the rest of the directory still counts
+						print("scan error {0}".format(e))
+		except OSError as e:
+			print("scan error {0}".format(e))
+		finally:
+			candidates.sort()
+			results.put((handler, path, candidates))
+			with lock:
+				outstanding[0] -= 1
+				if outstanding[0] == 0:
+					results.put(None)
+
+	if roots is None:
+		roots = [(handler, handler.SourceDirectory) for handler in handlers]
+	if not roots:
+		return
+
+	# Count all roots up front, so the first finished tree can't end the scan
+	outstanding[0] = len(roots)
+	for handler, path in roots:
+		executor.submit(ScanDirectory, handler, path)
+
+	try:
+		for handler, dirpath, candidates in iter(results.get, None):
+			for filename, stat in candidates:
+				yield handler, dirpath, filename, stat
+	finally:
+		executor.shutdown(wait=False)
+
+def Scan(handlers): # Normal mode
+	start = time.monotonic()
+	for handler, dirpath, filename, stat in ScanSources(handlers, args.scan_threads):
+		handler.Checkfile(dirpath, filename, stat)
+		metrics.Count("scanned_files")
+		metrics.Tick()
+	metrics.Set("scan_seconds", time.monotonic() - start)
+
+def Orphans(handlers, expected):
+	# Only look below the directories the sources map to
+	roots = tuple(os.path.join(parsed.path, os.path.basename(handler.SourceDirectory)) + "/" for handler in handlers)
+	# Published files are either compressed or raw, a raw file is only ours when
+	# the manifest published it, anything else was put there by hand
+	return sorted(path for path in remote.Files if (path.endswith(".bz2") or path.endswith(valid_extensions) and manifest.Lookup(path + ".bz2")) and path.startswith(roots)
+		and Variants(path)[0] not in expected and path + ".bz2" not in expected and os.path.basename(Variants(path)[-1]) not in ignore_names)
+
+def Reverse(handlers): # Reverse mode
+	# Set of everything the sources produce, from one parallel walk
+	expected = set()
+	for handler, dirpath, filename, stat in ScanSources(handlers, args.scan_threads):
+		expected.add(handler.Destination(dirpath, filename))
+
+	orphans = Orphans(handlers, expected)
+	reclaimed = sum(remote.FileSize(path) for path in orphans)
+
+	if args.dry_run:
+		for path in orphans:
+			print("{0} ({1} bytes)".format(os.path.relpath(path, commonprefix_ftp), remote.FileSize(path)))
+		print("{0} orphaned files, {1:.1f} MB would be reclaimed".format(len(orphans), reclaimed/1024/1024))
+		return
+
+	print("Deleting {0} orphaned files, {1:.1f} MB".format(len(orphans), reclaimed/1024/1024))
+	for i in range(0, len(orphans), args.batch_size):
+		jobs.put((DeleteBatch, tuple(orphans[i:i + args.batch_size])))
+
+def Estimate(item):
+	# Compresses the start of the file like ChoosePolicy does and scales the
+	# result to the whole file. Returns (level, output bytes, CPU seconds).
+	sourcefile, size = item
+	level = CompressionLevel(sourcefile)
+	if not level or not size:
+		return 0, size, 0
+	with open(sourcefile, "rb") as infile:
+		sample = infile.read(int(args.sample_size*1024*1024))
+	start = time.perf_counter()
+	with cpu.Slot():
+		compressed = bz2.compress(sample, level)
+	elapsed = time.perf_counter() - start
+	ratio = len(compressed)/len(sample)
+	if ratio > args.max_ratio:
+		return 0, size, elapsed # published raw, the sample is all it costs
+	return level, int(size*ratio), elapsed*size/len(sample)
+
+def Plan(handlers): # Plan mode
+	# The whole diff between sources and destination and what syncing it
+	# would cost, printed as JSON. Nothing is queued or uploaded.
+	expected = set()
+	candidates = [] # (kind, sourcefile, destfile, size)
+	unchanged = 0
+	for handler, dirpath, filename, stat in ScanSources(handlers, args.scan_threads):
+		sourcefile = os.path.join(dirpath, filename)
+		destfile = handler.Destination(dirpath, filename)
+		expected.add(destfile)
+		if manifest.Lookup(destfile):
+			if manifest.Unchanged(sourcefile, destfile, stat):
+				unchanged += 1
+				continue
+			candidates.append(("changes", sourcefile, destfile, stat.st_size))
+		elif any(remote.FileSize(path) for path in Variants(destfile)):
+			unchanged += 1 # the next scan adopts it
+		else:
+			candidates.append(("adds", sourcefile, destfile, stat.st_size))
+	deletes = Orphans(handlers, expected)
+
+	# A new file with the content of a deleted one is a rename
+	gone = collections.defaultdict(list)
+	for path in deletes:
+		entry = manifest.Lookup(path if path.endswith(".bz2") else path + ".bz2")
+		if entry and entry[2]:
+			gone[entry[0], entry[2]].append(path)
+	sizes = set(size for size, digest in gone)
+	moves = []
+	for candidate in [c for c in candidates if c[0] == "adds" and c[3] in sizes]:
+		kind, sourcefile, destfile, size = candidate
+		matches = gone.get((size, FileHash(sourcefile)))
+		if matches:
+			path = matches.pop()
+			moves.append({"source": path, "destination": destfile if path.endswith(".bz2") else destfile[:-4]})
+			candidates.remove(candidate)
+			deletes.remove(path)
+
+	plan = {"adds": [], "changes": [], "deletes": [], "moves": moves, "unchanged": unchanged, "journaled_jobs": journal.Count()}
+	totals = collections.Counter()
+	with concurrent.futures.ThreadPoolExecutor(max_workers=args.compress_threads) as executor:
+		estimates = executor.map(Estimate, [(sourcefile, size) for kind, sourcefile, destfile, size in candidates])
+		for (kind, sourcefile, destfile, size), (level, outsize, cputime) in zip(candidates, estimates):
+			plan[kind].append({"source": sourcefile, "destination": destfile if level else destfile[:-4], "size": size,
+				"level": level, "compressed_bytes": outsize, "cpu_seconds": round(cputime, 3)})
+			totals["source_bytes"] += size
+			totals["compressed_bytes"] += outsize
+			totals["cpu_seconds"] += cputime
+	for path in deletes:
+		plan["deletes"].append({"destination": path, "size": remote.FileSize(path)})
+		totals["deleted_bytes"] += remote.FileSize(path)
+
+	# Compression and uploads overlap, the slower side sets the pace
+	speed = args.link_speed or args.bandwidth
+	upload = totals["compressed_bytes"]/(speed*1024*1024) if speed else None
+	compress = totals["cpu_seconds"]/min(args.threads, os.cpu_count())
+	plan["totals"] = {
+		"files": len(candidates),
+		"source_bytes": totals["source_bytes"],
+		"compressed_bytes": totals["compressed_bytes"],
+		"deleted_bytes": totals["deleted_bytes"],
+		"cpu_seconds": round(totals["cpu_seconds"], 1),
+		"compress_seconds": round(compress, 1),
+		"upload_seconds": None if upload is None else round(upload, 1),
+		"wall_seconds": round(max(compress, upload or 0), 1),
+		"threads": args.threads,
+		# Compress threads needed to keep the link busy
+		"threads_to_saturate_link": max(1, math.ceil(totals["cpu_seconds"]/upload)) if upload else None,
+	}
+	json.dump(plan, sys.stdout, indent=1)
+	print()
+
+def SpotCheck(ftp, item):
+	# Download a published file and compare its content with the source
+	sourcefile, path = item
+	digest = hashlib.blake2b(digest_size=20)
+	state = {"decompressor": bz2.BZ2Decompressor() if path.endswith(".bz2") else None, "corrupt": False}
+
+	def Feed(data):
+		decompressor = state["decompressor"]
+		if decompressor is None:
+			digest.update(data)
+			return
+		try:
+			# Block-parallel output is a series of bzip2 streams
+			while data and not state["corrupt"]:
+				if decompressor.eof:
+					decompressor = state["decompressor"] = bz2.BZ2Decompressor()
+				digest.update(decompressor.decompress(data))
+				data = decompressor.unused_data
+		except OSError:
+			state["corrupt"] = True
+
+	ftp.retrbinary("RETR {0}".format(path), Feed, 64*1024)
+	if state["corrupt"] or (state["decompressor"] and not state["decompressor"].eof):
+		return False # not bzip2 data, or truncated
+	return digest.hexdigest() == FileHash(sourcefile)
+
+def Verify(handlers): # Verify mode
+	# Remote sizes come from the listing made at startup, one MLSD per
+	# directory instead of a SIZE per file. Anything that doesn't match the
+	# size recorded at upload is compressed and uploaded again.
+	mismatches = []
+	candidates = []
+	checked = 0
+	for handler, dirpath, filename, stat in ScanSources(handlers, args.scan_threads):
+		sourcefile = os.path.join(dirpath, filename)
+		destfile = handler.Destination(dirpath, filename)
+		published = [path for path in Variants(destfile) if remote.FileExists(path)]
+		entry = manifest.Lookup(destfile)
+		checked += 1
+
+		if not published:
+			reason = "Missing"
+		elif not remote.FileSize(published[0]):
+			reason = "Empty"
+		elif entry is None:
+			reason = None # never uploaded by us, only a spot check can tell
+		elif entry[3] is not None and entry[3] != remote.FileSize(published[0]):
+			reason = "Size mismatch"
+		elif not manifest.Unchanged(sourcefile, destfile, stat):
+			reason = "Changed"
+		else:
+			reason = None
+
+		if reason:
+			mismatches.append((sourcefile, destfile))
+			PrettyPrint(os.path.relpath(sourcefile, commonprefix), reason)
+		else:
+			candidates.append((sourcefile, published[0]))
+
+	# Sizes can't catch a corrupt file of the right length
+	sample = random.sample(candidates, min(len(candidates), int(len(candidates)*args.spot_check/100 + 0.5)))
+	with concurrent.futures.ThreadPoolExecutor(max_workers=args.connections or args.threads) as executor:
+		results = executor.map(lambda item: pool.Run(SpotCheck, item), sample)
+		for (sourcefile, path), matches in zip(sample, results):
+			if not matches:
+				mismatches.append((sourcefile, Variants(path)[0]))
+				PrettyPrint(os.path.relpath(sourcefile, commonprefix), "Content mismatch")
+
+	metrics.Count("verified_files", checked)
+	metrics.Count("verify_mismatches", len(mismatches))
+	print("Verified {0} files, spot-checked {1}, {2} mismatched".format(checked, len(sample), len(mismatches)))
+	for sourcefile, destfile in mismatches:
+		jobs.put((Compress, sourcefile, destfile))
+
+def EventLoop(notifier):
+	# Wait for events no longer than until the next coalesced job is due
+	if notifier.check_events(timeout=pending.Timeout()):
+		notifier.read_events()
+		notifier.process_events()
+	pending.Flush()
+	reconciler.Tick()
+	metrics.Tick()
+
 def Worker():
 	while True:
 		job = jobs.get()
+		handoff = False
 		try:
 			if args.dry_run:
 				print("Job: {0}({1})".format(job[0].__name__, job[1]))
+			elif job[0] is Compress and ready:
+				# Blocks while the upload stage is behind, the uploader finishes the job
+				ready.put((job, Prepare(job[1:])))
+				handoff = True
 			else:
-				ftp = ftplib.FTP(parsed.netloc)
-				ftp.login(USER, PASSWORD)
-
-				job[0](ftp, job[1:])
-
-				ftp.quit()
+				pool.Run(job[0], job[1:])
+				metrics.Count(job[0].__name__.lower() + "_jobs")
+				for path in (job[1] if job[0] is DeleteBatch else job[-1:]):
+					metrics.Published(path)
 		except Exception as e:
+			metrics.Count("errors")
 			print("worker error {0}".format(e))
 			print(traceback.format_exc())
 		finally:
+			if not handoff:
+				jobs.Done(job)
 			jobs.task_done()
 
+def Uploader():
+	while True:
+		job, artifact = ready.get()
+		try:
+			pool.Run(Upload, job[1:], artifact)
+			metrics.Count("compress_jobs")
+			metrics.Published(job[-1])
+		except Exception as e:
+			metrics.Count("errors")
+			print("upload error {0}".format(e))
+			print(traceback.format_exc())
+			if os.path.exists(artifact[0]):
+				os.remove(artifact[0])
+		finally:
+			jobs.Done(job)
+			ready.task_done()
+
+# Minimal FTP client on asyncio streams, just the commands the sync jobs use.
+# Replies are checked like ftplib does and raise the same exceptions, so
+# FTP_TRANSIENT_ERRORS and the error handling around it apply unchanged.
+class AsyncFTP:
+	def __init__(self, host, port, user, password):
+		self.Host = host
+		self.Port = port
+		self.User = user
+		self.Password = password
+		self.Ready = False
+
+	async def Connect(self):
+		self.Reader, self.Writer = await asyncio.wait_for(asyncio.open_connection(self.Host, self.Port), 60)
+		await self.Response()
+		if (await self.Command("USER " + self.User)).startswith("3"):
+			await self.Command("PASS " + self.Password)
+		await self.voidcmd("TYPE I")
+		self.Ready = True
+
+	async def Response(self):
+		line = (await asyncio.wait_for(self.Reader.readline(), 60)).decode("utf-8", "replace")
+		if not line:
+			raise EOFError
+		if line[3:4] == "-":
+			# Multi-line reply, ends with the same code followed by a space
+			end = line[:3] + " "
+			while True:
+				following = (await asyncio.wait_for(self.Reader.readline(), 60)).decode("utf-8", "replace")
+				if not following:
+					raise EOFError
+				line += following
+				if following.startswith(end):
+					break
+		response = line.rstrip("\r\n")
+		if response[:1] == "4":
+			raise ftplib.error_temp(response)
+		if response[:1] == "5":
+			raise ftplib.error_perm(response)
+		return response
+
+	async def Command(self, command):
+		self.Writer.write((command + "\r\n").encode("utf-8"))
+		await self.Writer.drain()
+		return await self.Response()
+
+	async def voidcmd(self, command):
+		response = await self.Command(command)
+		if not response.startswith("2"):
+			raise ftplib.error_reply(response)
+		return response
+
+	async def size(self, path):
+		response = await self.voidcmd("SIZE " + path)
+		return int(response[3:].strip())
+
+	async def delete(self, path):
+		return await self.voidcmd("DELE " + path)
+
+	async def mkd(self, path):
+		return await self.voidcmd("MKD " + path)
+
+	async def rmd(self, path):
+		return await self.voidcmd("RMD " + path)
+
+	async def rename(self, sourcepath, destpath):
+		response = await self.Command("RNFR " + sourcepath)
+		if not response.startswith("3"):
+			raise ftplib.error_reply(response)
+		return await self.voidcmd("RNTO " + destpath)
+
+	async def DataConnection(self):
+		# Extended passive mode first, plain PASV for older servers
+		try:
+			response = await self.voidcmd("EPSV")
+			port = int(response[response.index("(") + 1:response.index(")")].strip("|"))
+			host = self.Host
+		except ftplib.error_perm:
+			response = await self.voidcmd("PASV")
+			numbers = response[response.index("(") + 1:response.index(")")].split(",")
+			host = ".".join(numbers[:4])
+			port = int(numbers[4])*256 + int(numbers[5])
+		return await asyncio.wait_for(asyncio.open_connection(host, port), 60)
+
+	async def Store(self, command, infile):
+		# STOR or APPE from a local file, paced by the shared bandwidth bucket.
+		# Reads go to the default executor, a slow disk must not stall the loop.
+		loop = asyncio.get_running_loop()
+		reader, writer = await self.DataConnection()
+		try:
+			response = await self.Command(command)
+			if not response.startswith("1"):
+				raise ftplib.error_reply(response)
+			while True:
+				chunk = await loop.run_in_executor(None, infile.read, 64*1024)
+				if not chunk:
+					break
+				await asyncio.sleep(bandwidth.Reserve(len(chunk)))
+				writer.write(chunk)
+				await writer.drain()
+		finally:
+			writer.close()
+		await writer.wait_closed()
+		return await self.Response()
+
+	def close(self):
+		self.Writer.close()
+
+	async def quit(self):
+		try:
+			await self.voidcmd("QUIT")
+		finally:
+			self.close()
+
+# Blocking view of an AsyncFTP for the sync job functions (Delete, Move, ...),
+# which run in their own executor while their commands go through the event loop.
+class SyncFTP:
+	def __init__(self, ftp, loop):
+		self.FTP = ftp
+		self.Loop = loop
+
+	def __getattr__(self, name):
+		method = getattr(self.FTP, name)
+		return lambda *params: asyncio.run_coroutine_threadsafe(method(*params), self.Loop).result()
+
+class AsyncPool:
+	def __init__(self, url, idle_timeout, retries, retry_delay):
+		self.Host = url.hostname
+		self.Port = url.port or 21
+		self.User = url.username or USER
+		self.Password = url.password or PASSWORD
+		self.IdleTimeout = idle_timeout
+		self.Retries = retries
+		self.RetryDelay = retry_delay
+		self.Idle = [] # (ftp, last used) pairs, most recently used last
+
+	def Reap(self):
+		# Close connections that have been idle for too long
+		now = time.monotonic()
+		for ftp, used in self.Idle:
+			if now - used > self.IdleTimeout:
+				ftp.close()
+		self.Idle = [(ftp, used) for ftp, used in self.Idle if now - used <= self.IdleTimeout]
+
+	async def Reaper(self):
+		while True:
+			await asyncio.sleep(FTP_HEALTHCHECK_INTERVAL)
+			self.Reap()
+
+	async def Acquire(self):
+		# Same health check as FTPPool.Acquire
+		self.Reap()
+		while self.Idle:
+			ftp, used = self.Idle.pop()
+			if time.monotonic() - used < FTP_HEALTHCHECK_INTERVAL:
+				return ftp
+			try:
+				await ftp.voidcmd("NOOP")
+				return ftp
+			except FTP_TRANSIENT_ERRORS:
+				ftp.close()
+		return None
+
+	def Release(self, ftp):
+		self.Idle.append((ftp, time.monotonic()))
+
+	async def Run(self, func, *params):
+		# Same retry policy as FTPPool.Run
+		for attempt in range(self.Retries + 1):
+			ftp = await self.Acquire()
+			try:
+				if ftp is None:
+					ftp = AsyncFTP(self.Host, self.Port, self.User, self.Password)
+					await ftp.Connect()
+				result = await func(ftp, *params)
+				self.Release(ftp)
+				return result
+			except FTP_TRANSIENT_ERRORS as e:
+				if ftp is not None and hasattr(ftp, "Writer"):
+					ftp.close()
+				if attempt == self.Retries:
+					raise
+				delay = min(self.RetryDelay*2**attempt, FTP_MAX_RETRY_DELAY)
+				metrics.Count("retries")
+				print("{0}, retrying in {1:.1f}s".format(e, delay))
+				await asyncio.sleep(delay)
+			except:
+				if ftp is not None and ftp.Ready:
+					self.Release(ftp)
+				raise
+
+async def AsyncUpload(ftp, item, artifact, commands):
+	# Upload() for the asyncio engine. Only the transfer runs on the loop,
+	# the commands around it are the sync helpers going through SyncFTP.
+	loop = asyncio.get_running_loop()
+	sync = SyncFTP(ftp, loop)
+	target, part, size, offset = await loop.run_in_executor(commands, PrepareUpload, sync, item, artifact)
+
+	start = time.perf_counter()
+	with open(artifact[0], "rb") as infile:
+		infile.seek(offset)
+		await ftp.Store(("APPE " if offset else "STOR ") + part, infile)
+	elapsed = time.perf_counter() - start
+
+	await loop.run_in_executor(commands, CompleteUpload, sync, item, artifact, target, part, size, offset, elapsed)
+
+async def AsyncSync(ftp, job, commands):
+	# Any other job, run by its sync function with commands going through the loop
+	loop = asyncio.get_running_loop()
+	return await loop.run_in_executor(commands, job[0], SyncFTP(ftp, loop), job[1:])
+
+async def AsyncJob(apool, executor, commands, slots, job):
+	loop = asyncio.get_running_loop()
+	try:
+		if args.dry_run:
+			print("Job: {0}({1})".format(job[0].__name__, job[1]))
+		elif job[0] is Compress:
+			# Compression in the executor, the transfer on the loop
+			artifact = await loop.run_in_executor(executor, Prepare, job[1:])
+			try:
+				await apool.Run(AsyncUpload, job[1:], artifact, commands)
+			except:
+				if os.path.exists(artifact[0]):
+					os.remove(artifact[0])
+				raise
+		else:
+			await apool.Run(AsyncSync, job, commands)
+		if not args.dry_run:
+			metrics.Count(job[0].__name__.lower() + "_jobs")
+			for path in (job[1] if job[0] is DeleteBatch else job[-1:]):
+				metrics.Published(path)
+	except Exception as e:
+		metrics.Count("errors")
+		print("worker error {0}".format(e))
+		print(traceback.format_exc())
+	finally:
+		jobs.Done(job)
+		jobs.task_done()
+		slots.release()
+
+def AsyncFeeder(loop, incoming):
+	# Daemon thread, blocking on the job queue must not keep the process alive
+	while True:
+		job = jobs.get()
+		asyncio.run_coroutine_threadsafe(incoming.put(job), loop).result()
+
+async def AsyncEngine(connections, threads):
+	# One event loop drives every transfer, -t threads compress
+	loop = asyncio.get_running_loop()
+	apool = AsyncPool(parsed, args.idle_timeout, args.retries, args.retry_delay)
+	reaper = asyncio.ensure_future(apool.Reaper())
+	executor = concurrent.futures.ThreadPoolExecutor(max_workers=threads)
+	# The sync helpers only wait for commands on the loop, one thread per
+	# connection so they never queue behind compression or each other
+	commands = concurrent.futures.ThreadPoolExecutor(max_workers=connections)
+	slots = asyncio.Semaphore(connections)
+	incoming = asyncio.Queue(maxsize=1)
+	feeder_thread = threading.Thread(target=AsyncFeeder, args=(loop, incoming))
+	feeder_thread.daemon = True
+	feeder_thread.start()
+
+	running = set()
+	while True:
+		await slots.acquire()
+		job = await incoming.get()
+		task = asyncio.ensure_future(AsyncJob(apool, executor, commands, slots, job))
+		running.add(task)
+		task.add_done_callback(running.discard)
+
+# Raised from the SIGTERM handler in the main thread
+class Checkpoint(Exception):
+	pass
+
+def Terminate(signum, frame):
+	raise Checkpoint()
+
+# Holds inotify jobs back for a quiet period, keyed on destination path, so
+# repeated writes, write+delete and write+rename collapse into one job.
+class EventCoalescer:
+	def __init__(self, delay, exists):
+		self.Delay = delay
+		self.Exists = exists # whether a destination path is already published
+		self.Lock = threading.Lock()
+		self.Pending = collections.OrderedDict() # destination path -> (job, due time)
+
+	def Schedule(self, key, job):
+		self.Pending.pop(key, None)
+		self.Pending[key] = (job, time.monotonic() + self.Delay)
+
+	def Subtree(self, path):
+		prefix = path + "/"
+		return [key for key in self.Pending if key.startswith(prefix)]
+
+	def Put(self, job, source=None):
+		metrics.EventSeen(job[-1])
+		with self.Lock:
+			if job[0] is Compress:
+				previous = self.Pending.get(job[2])
+				if previous and previous[0][0] is Move and previous[0][1] not in self.Pending and self.Exists(previous[0][1]):
+					# Renamed then rewritten, the old name won't be moved away anymore
+					self.Schedule(previous[0][1], (Delete, previous[0][1]))
+				self.Schedule(job[2], job)
+
+			elif job[0] is Delete:
+				destpath = job[1]
+				for key in self.Subtree(destpath):
+					del self.Pending[key]
+
+				previous = self.Pending.pop(destpath, None)
+				if previous and previous[0][0] is Compress and not self.Exists(destpath):
+					# Written and deleted again before it was ever published
+					metrics.Forget(destpath)
+					return
+				self.Schedule(destpath, job)
+
+			elif job[0] is Move:
+				sourcepath, destpath = job[1:]
+				self.Pending.pop(destpath, None)
+
+				# Directory rename, point pending jobs below it to the new location
+				if source and os.path.isdir(source[1]):
+					moved = [(key, self.Pending.pop(key)[0]) for key in self.Subtree(sourcepath)]
+					if self.Exists(sourcepath):
+						self.Schedule(destpath, job)
+					for key, pendingjob in moved:
+						newkey = destpath + key[len(sourcepath):]
+						if pendingjob[0] is Compress and pendingjob[1].startswith(source[0] + "/"):
+							pendingjob = (Compress, source[1] + pendingjob[1][len(source[0]):], newkey)
+						elif pendingjob[0] is Delete:
+							pendingjob = (Delete, newkey)
+						elif pendingjob[0] is Move and pendingjob[1].startswith(sourcepath + "/"):
+							# Runs after the directory move, so its source has moved too
+							pendingjob = (Move, destpath + pendingjob[1][len(sourcepath):], newkey)
+						self.Schedule(newkey, pendingjob)
+					return
+
+				previous = self.Pending.pop(sourcepath, None)
+				if previous and previous[0][0] is Compress and source:
+					# Written then renamed, compress once under the final name
+					if self.Exists(sourcepath):
+						self.Schedule(sourcepath, (Delete, sourcepath))
+					self.Schedule(destpath, (Compress, source[1], destpath))
+				elif previous and previous[0][0] is Move:
+					# Renamed twice, move straight to the final name
+					self.Schedule(destpath, (Move, previous[0][1], destpath))
+				else:
+					self.Schedule(destpath, job)
+
+	def Timeout(self):
+		# Milliseconds until the next pending job is due, capped at one second
+		with self.Lock:
+			if not self.Pending:
+				return 1000
+			due = next(iter(self.Pending.values()))[1]
+		return int(min(max(due - time.monotonic(), 0), 1)*1000)
+
+	def Flush(self, force=False):
+		now = time.monotonic()
+		deletes = []
+		with self.Lock:
+			while self.Pending:
+				key, (job, due) = next(iter(self.Pending.items()))
+				if due > now and not force:
+					break
+				del self.Pending[key]
+				if job[0] is Delete:
+					deletes.append(job[1])
+					if len(deletes) == args.batch_size:
+						self.PutDeletes(deletes)
+					continue
+				self.PutDeletes(deletes) # keep the order
+				jobs.put(job)
+			self.PutDeletes(deletes)
+
+	def PutDeletes(self, deletes):
+		# Deletes due together run as one batch, followed by a single prune
+		if len(deletes) == 1:
+			jobs.put((Delete, deletes[0]))
+		elif deletes:
+			jobs.put((DeleteBatch, tuple(deletes)))
+		del deletes[:]
 
 class EventHandler(pyinotify.ProcessEvent):
-	def my_init(self, source, destination):
+	def my_init(self, source, destination, watchmanager):
 		self.SourceDirectory = os.path.abspath(source)
 		self.DestinationDirectory = os.path.abspath(destination)
+		self.WatchManager = watchmanager
+
+	def process_IN_CREATE(self, event):
+		# auto_add asks for these. Whatever landed in a new directory before
+		# its watch was added went unnoticed.
+		if event.dir:
+			reconciler.Lost(event.pathname, self.WatchManager.get_wd(event.pathname) is None)
 
 	def process_IN_CLOSE_WRITE(self, event):
 		if not event.pathname.endswith(valid_extensions) or os.path.basename(event.pathname) in ignore_names:
 			return
 
 		destpath = os.path.join(self.DestinationDirectory, os.path.relpath(event.pathname, os.path.join(self.SourceDirectory, "..")))
-		jobs.put((Compress, event.pathname, destpath + ".bz2"))
+		pending.Put((Compress, event.pathname, destpath + ".bz2"))
 
 	def process_IN_DELETE(self, event):
 		destpath = os.path.join(self.DestinationDirectory, os.path.relpath(event.pathname, os.path.join(self.SourceDirectory, "..")))
 		if event.dir:
-			if os.path.exists(destpath):
-				jobs.put((Delete, destpath))
+			if remote.DirExists(destpath):
+				pending.Put((Delete, destpath))
 		else:
 			if not event.pathname.endswith(valid_extensions) or os.path.basename(event.pathname) in ignore_names:
 				return
 
-			jobs.put((Delete, destpath + ".bz2"))
+			pending.Put((Delete, destpath + ".bz2"))
 
 	def process_IN_MOVED_TO(self, event):
 		# Moved from untracked directory, handle as new file
 		if not hasattr(event, "src_pathname"):
+			if event.dir:
+				reconciler.Lost(event.pathname, self.WatchManager.get_wd(event.pathname) is None)
+				return
 			if not event.pathname.endswith(valid_extensions) or os.path.basename(event.pathname) in ignore_names:
 				return
 
 			destpath = os.path.join(self.DestinationDirectory, os.path.relpath(event.pathname, os.path.join(self.SourceDirectory, "..")))
-			jobs.put((Compress, event.pathname, destpath + ".bz2"))
+			pending.Put((Compress, event.pathname, destpath + ".bz2"))
 			return
 
 		# Moved inside tracked directory, handle as rename
@@ -225,22 +1755,22 @@ class EventHandler(pyinotify.ProcessEvent):
 		destpath = os.path.join(self.DestinationDirectory, os.path.relpath(event.pathname, os.path.join(self.SourceDirectory, "..")))
 
 		if event.dir:
-			jobs.put((Move, sourcepath, destpath))
+			pending.Put((Move, sourcepath, destpath), source=(event.src_pathname, event.pathname))
 		else:
 			if event.src_pathname.endswith(valid_extensions) in ignore_names or os.path.basename(event.pathname) in ignore_names:
 				return
 
 			if not event.src_pathname.endswith(valid_extensions) and event.pathname.endswith(valid_extensions):
 				# Renamed invalid_ext file to valid one -> compress
-				jobs.put((Compress, event.pathname, destpath + ".bz2"))
+				pending.Put((Compress, event.pathname, destpath + ".bz2"))
 				return
 
 			elif event.src_pathname.endswith(valid_extensions) and not event.pathname.endswith(valid_extensions):
 				# Renamed valid_ext file to invalid one -> delete from destination
-				jobs.put((Delete, sourcepath + ".bz2"))
+				pending.Put((Delete, sourcepath + ".bz2"))
 				return
 
-			jobs.put((Move, sourcepath + ".bz2", destpath + ".bz2"))
+			pending.Put((Move, sourcepath + ".bz2", destpath + ".bz2"), source=(event.src_pathname, event.pathname))
 
 
 class DirectoryHandler:
@@ -250,83 +1780,337 @@ class DirectoryHandler:
 
 		if watchmanager:
 			self.WatchManager = watchmanager
-			self.NotifyHandler = EventHandler(source=self.SourceDirectory, destination=self.DestinationDirectory)
-			self.NotifyNotifier = pyinotify.Notifier(self.WatchManager, self.NotifyHandler, timeout=1000)
-			self.NotifyWatch = self.WatchManager.add_watch(self.SourceDirectory, NOTIFY_MASK, rec=True, auto_add=True)
+			self.NotifyHandler = EventHandler(source=self.SourceDirectory, destination=self.DestinationDirectory, watchmanager=watchmanager)
+			self.Unwatched = self.Watch(self.SourceDirectory)
+
+	def Watch(self, path):
+		# Returns the directories that couldn't be watched, fs.inotify.max_user_watches
+		# is the usual suspect. pyinotify only logs those.
+		result = self.WatchManager.add_watch(path, NOTIFY_MASK, proc_fun=self.NotifyHandler, rec=True, auto_add=True)
+		return [directory for directory, wd in result.items() if wd < 0]
 
 	def __enter__(self):
 		return self
 
 	def __exit__(self, type, value, traceback):
-		self.WatchManager.rm_watch(self.NotifyWatch, rec=True)
+		self.WatchManager.rm_watch(self.WatchManager.get_wd(self.SourceDirectory), rec=True)
 
-	def Loop(self):
-		self.NotifyNotifier.process_events()
-		while self.NotifyNotifier.check_events():
-			self.NotifyNotifier.read_events()
-			self.NotifyNotifier.process_events()
+	def DestinationDir(self, dirpath):
+		return os.path.join(self.DestinationDirectory, os.path.relpath(dirpath, os.path.join(self.SourceDirectory, "..")))
 
-	def Do(self, ftp): # Normal mode
-		for dirpath, dirnames, filenames in os.walk(self.SourceDirectory):
-			filenames.sort()
-			for filename in [f for f in filenames if f.endswith(valid_extensions) and f not in ignore_names]:
-				self.Checkfile(ftp, dirpath, filename)
+	def Destination(self, dirpath, filename):
+		return os.path.join(self.DestinationDir(dirpath), filename + ".bz2")
 
-	def Checkfile(self, ftp, dirpath, filename):
+	def Checkfile(self, dirpath, filename, stat=None, reconcile=False):
+		# Reconciling, changes go through the coalescer and unchanged files aren't reported
 		sourcefile = os.path.join(dirpath, filename)
-		destfile = os.path.join(self.DestinationDirectory, os.path.relpath(dirpath, os.path.join(self.SourceDirectory, "..")), filename + ".bz2")
-
-		if FTP_FileExists(ftp, destfile):
-			PrettyPrint(os.path.relpath(sourcefile, commonprefix), "Exists")
+		destfile = self.Destination(dirpath, filename)
+		if not reconcile and destfile in journal.Replayed:
+			return # the startup scan leaves jobs queued again from the journal alone
+		if reconcile and jobs.Pending(destfile):
+			return # no manifest entry until the queued or running job is done
+
+		if manifest.Lookup(destfile):
+			# Known file, a single stat tells whether it needs recompression
+			exists = manifest.Unchanged(sourcefile, destfile, stat)
+			status = "Exists" if exists else "Changed"
+		elif any(remote.FileSize(path) for path in Variants(destfile)):
+			# Uploaded before the manifest existed, adopt it unless it's empty
+			stat = stat or os.stat(sourcefile)
+			manifest.Update(destfile, stat.st_size, stat.st_mtime_ns, None)
+			exists = True
+			status = "Exists"
 		else:
-			PrettyPrint(os.path.relpath(sourcefile, commonprefix), "Added")
-			jobs.put((Compress, sourcefile, destfile))
+			exists = False
+			status = "Added"
+
+		if not (reconcile and exists):
+			PrettyPrint(os.path.relpath(sourcefile, commonprefix), status)
+		if not exists:
+			(pending.Put if reconcile else jobs.put)((Compress, sourcefile, destfile))
+		elif mirrors and not all(mirror.Exists(os.path.relpath(destfile, parsed.path)) for mirror in mirrors):
+			# New or lagging mirror
+			jobs.put((CompressMirrors, sourcefile, destfile))
+
+# inotify drops events when its queue overflows and can't watch directories
+# past fs.inotify.max_user_watches. Subtrees affected by either are rescanned
+# in the background with the same stat-only check as the startup scan, and
+# unwatched ones keep being polled until a watch can be added. A periodic
+# pass over everything catches whatever slipped through anyway.
+class Reconciler:
+	def __init__(self, handlers, interval, retry_interval):
+		self.Handlers = handlers
+		self.Interval = interval
+		self.RetryInterval = retry_interval
+		self.Lock = threading.Lock()
+		self.Dirty = set() # source directories to rescan
+		self.Unwatched = set(path for handler in handlers for path in handler.Unwatched)
+		self.NextFull = time.monotonic() + interval if interval else None
+		self.NextRetry = time.monotonic() + retry_interval
+		self.Thread = None
+
+		if self.Unwatched:
+			print("{0} directories could not be watched (fs.inotify.max_user_watches?), polling them every {1}s".format(len(self.Unwatched), retry_interval))
+
+	def Handler(self, path):
+		for handler in self.Handlers:
+			if path == handler.SourceDirectory or path.startswith(handler.SourceDirectory + "/"):
+				return handler
+
+	def Lost(self, path, unwatched=False):
+		with self.Lock:
+			self.Dirty.add(path)
+			if unwatched and path not in self.Unwatched:
+				print("Can't watch {0} (fs.inotify.max_user_watches?), polling it every {1}s".format(path, self.RetryInterval))
+				self.Unwatched.add(path)
+				metrics.Count("unwatched_directories")
+
+	def Overflow(self):
+		# The kernel doesn't say which events were dropped
+		print("inotify queue overflowed, rescanning sources")
+		metrics.Count("inotify_overflows")
+		with self.Lock:
+			self.Dirty.update(handler.SourceDirectory for handler in self.Handlers)
+
+	def Tick(self):
+		# From the main loop, it owns the watch manager
+		now = time.monotonic()
+		if self.Unwatched and now >= self.NextRetry:
+			self.NextRetry = now + self.RetryInterval
+			with self.Lock:
+				unwatched = Outermost(self.Unwatched)
+				self.Unwatched = set()
+			for path in unwatched:
+				if os.path.isdir(path):
+					self.Lost(path)
+					failed = self.Handler(path).Watch(path)
+					with self.Lock:
+						self.Unwatched.update(failed)
+
+		if self.NextFull and now >= self.NextFull:
+			self.NextFull = now + self.Interval
+			with self.Lock:
+				self.Dirty.update(handler.SourceDirectory for handler in self.Handlers)
+
+		if not self.Dirty or (self.Thread and self.Thread.is_alive()):
+			return
+		with self.Lock:
+			roots = [(self.Handler(path), path) for path in Outermost(self.Dirty) if os.path.isdir(path)]
+			self.Dirty = set()
+		self.Thread = threading.Thread(target=self.Rescan, args=(roots,))
+		self.Thread.daemon = True
+		self.Thread.start()
+
+	def Rescan(self, roots):
+		# Jobs go through the coalescer, a file still being written gets one
+		# job once it's done, whether the scan or inotify saw it first
+		start = time.monotonic()
+		seen = set()
+		for handler, dirpath, filename, stat in ScanSources(self.Handlers, args.scan_threads, roots):
+			handler.Checkfile(dirpath, filename, stat, reconcile=True)
+			seen.add(handler.Destination(dirpath, filename))
+			metrics.Count("rescanned_files")
+
+		# Published files whose source is gone, their delete events were lost
+		for handler, path in roots:
+			for destfile in manifest.Below(handler.DestinationDir(path)):
+				sourcefile = os.path.join(handler.SourceDirectory, "..", os.path.relpath(destfile[:-4], handler.DestinationDirectory))
+				if destfile not in seen and not os.path.exists(sourcefile):
+					pending.Put((Delete, destfile))
+		metrics.Set("rescan_seconds", time.monotonic() - start)
+
+def Outermost(paths):
+	# Drops every path that lies below another one
+	result = []
+	for path in sorted(paths, key=lambda path: path.count("/")):
+		if not any(path.startswith(parent + "/") for parent in result):
+			result.append(path)
+	return result
+
+class OverflowHandler(pyinotify.ProcessEvent):
+	# Default handler of the notifier, IN_Q_OVERFLOW belongs to no watch
+	def process_IN_Q_OVERFLOW(self, event):
+		reconciler.Overflow()
 
 
 if __name__ == "__main__":
 	parser = argparse.ArgumentParser(description="Automate FastDL BZip2 process")
+	parser.add_argument("-q", "--quiet", action="store_true", help="Don't print a status line per file")
 	parser.add_argument("-t", "--threads", type=int, default=1, help="Worker thread count")
+	parser.add_argument("--engine", choices=["threads", "asyncio"], default="threads", help="Transfer engine. asyncio runs -c concurrent transfers (default 16) on one event loop, -t threads compress")
+	parser.add_argument("--pipeline", action="store_true", help="Compress and upload in separate stages, -t threads compress and --upload-threads threads upload")
+	parser.add_argument("--upload-threads", type=int, default=None, help="Upload threads in pipeline mode (default: connection pool size)")
+	parser.add_argument("--ready-queue", type=int, default=8, help="Compressed files waiting for upload in pipeline mode before compression pauses")
+	parser.add_argument("-c", "--connections", type=int, default=None, help="FTP connection pool size (default: same as thread count)")
+	parser.add_argument("--idle-timeout", type=int, default=300, help="Close pooled FTP connections idle for this many seconds")
+	parser.add_argument("--retries", type=int, default=5, help="Retries after a dropped connection, uploads resume where they stopped")
+	parser.add_argument("--retry-delay", type=float, default=1, help="Seconds before the first retry, doubled every time")
+	parser.add_argument("-r", "--reverse", action="store_true", help="Reverse mode. Deletes remote files whose source no longer exists.")
+	parser.add_argument("--verify", action="store_true", help="Verify mode. Checks remote files against the sizes recorded at upload and uploads mismatches again.")
+	parser.add_argument("--spot-check", type=float, default=0, help="Percentage of files verify mode downloads and compares with their source")
+	parser.add_argument("--batch-size", type=int, default=100, help="Number of deletes sent over one connection before the empty directories get pruned")
 	parser.add_argument("--dry-run", action="store_true", help="Test mode (don't run any jobs, just print them)")
+	parser.add_argument("--plan", action="store_true", help="Plan mode. Prints the changes a sync would make and estimates of its size, CPU and upload time as JSON, then exits")
+	parser.add_argument("--link-speed", type=float, default=None, help="Upload speed in MB/s used by plan mode (default: --bandwidth)")
+	parser.add_argument("--manifest", default=None, help="Sync manifest database (default: ~/.fastdl_manifest_<host>.sqlite)")
+	parser.add_argument("--compress-threads", type=int, default=os.cpu_count(), help="Threads used to compress large files block-parallel")
+	parser.add_argument("--parallel-threshold", type=int, default=None, help="Compress files of at least this many MB block-parallel. Off by default: the result is a series of bzip2 streams, decoders that stop at the first end of stream (Source clients may be among them) only get the first 900 kB")
+	parser.add_argument("--bandwidth", type=float, default=None, help="Upload limit in MB/s, shared by all connections and mirrors")
+	parser.add_argument("--max-compress", type=int, default=os.cpu_count(), help="Most threads compressing at the same time, across all jobs")
+	parser.add_argument("--max-load", type=float, default=None, help="Pause compression while the 1 minute load average is above this")
+	parser.add_argument("--nice", type=int, default=0, help="Raise the niceness of the whole process by this much")
+	parser.add_argument("--idle-io", action="store_true", help="Run with idle I/O priority (ionice -c 3)")
+	parser.add_argument("--debounce", type=float, default=2.0, help="Seconds a file has to stay quiet before its changes are synced")
+	parser.add_argument("--priority", action="append", default=[], metavar="NAME=CLASS", help="Compress priority class for an extension (.mdl) or directory name (materials), lower runs first. Defaults: .bsp=1, default=3")
+	parser.add_argument("--max-wait", type=float, default=60, help="Jobs waiting longer than this many seconds run next regardless of priority")
+	parser.add_argument("--no-scan", action="store_true", help="Skip the startup scan, only replay the journal. For restarts when the sources didn't change meanwhile")
+	parser.add_argument("--scan-threads", type=int, default=8, help="Threads used to walk the source trees at startup")
+	parser.add_argument("--reconcile-interval", type=float, default=3600, help="Rescan the sources every this many seconds for changes inotify missed, 0 disables. Overflows and failed watches trigger a rescan of their own")
+	parser.add_argument("--watch-retry", type=float, default=60, help="Seconds between attempts to watch directories that hit fs.inotify.max_user_watches, they are polled meanwhile")
+	parser.add_argument("--stats-interval", type=float, default=60, help="Print a statistics summary every this many seconds")
+	parser.add_argument("--stats-file", default=None, help="Write statistics as JSON to this file every --stats-interval")
+	parser.add_argument("--metrics-port", type=int, default=None, help="Serve Prometheus metrics over HTTP on this port")
+	parser.add_argument("--metrics-address", default="127.0.0.1", help="Address the metrics endpoint listens on, 0.0.0.0 for all interfaces")
+	parser.add_argument("-m", "--mirror", action="append", default=[], help="Additional destination, local path or ftp:// URL. Files are compressed once and published to all")
+	parser.add_argument("--mirror-threads", type=int, default=2, help="Worker threads (and FTP connections) per mirror")
+	parser.add_argument("--cache-dir", default=os.path.expanduser("~/.fastdl_cache"), help="Compressed artifacts waiting for upload or mirrors, every process uses its own subdirectory")
+	parser.add_argument("--level", action="append", default=[], metavar="NAME=LEVEL", help="bzip2 level for an extension (.mp3) or directory name (sound), 0 publishes the raw file. Default: default=9")
+	parser.add_argument("--sample-size", type=float, default=1, help="MB from the start of each file used to estimate its compression ratio")
+	parser.add_argument("--max-ratio", type=float, default=0.95, help="Publish the raw file when the sample compresses worse than this ratio")
 	parser.add_argument("source", nargs='+', help="Source Path")
 	parser.add_argument("destination", help="Destination Path")
 	args = parser.parse_args()
 
+	LowerPriority(args.nice, args.idle_io)
+
 	parsed = urlparse(args.destination)
 	if not parsed.scheme == "ftp":
 		print("Destination is not an ftp address!")
 		sys.exit(1)
 
-	ftp = ftplib.FTP(parsed.netloc)
-	ftp.login(USER, PASSWORD)
-
 	# make common prefix for better logging
 	commonprefix = os.path.abspath(os.path.join(os.path.dirname(os.path.commonprefix(args.source)), ".."))
 	commonprefix_ftp = os.path.dirname(parsed.path)
 
-	jobs = queue.Queue()
-
-	# Create initial jobs
+	manifestpath = args.manifest or os.path.expanduser("~/.fastdl_manifest_{0}.sqlite".format(parsed.hostname))
+	manifest = Manifest(manifestpath, args.dry_run)
+	# The manifest is shared by every daemon syncing to this host
+	journal = Journal(":memory:" if args.dry_run else manifestpath, "{0}:{1}{2}".format(parsed.hostname, parsed.port or 21, parsed.path))
+
+	block_pool = concurrent.futures.ThreadPoolExecutor(max_workers=args.compress_threads)
+	cpu = CPUBudget(args.max_compress, args.max_load)
+	bandwidth = TokenBucket(args.bandwidth and args.bandwidth*1024*1024)
+
+	levels = ParseLevels(args.level)
+
+	metrics = Metrics()
+	if args.metrics_port:
+		metrics.Serve(args.metrics_address, args.metrics_port)
+
+	pool = FTPPool(parsed, args.connections or args.threads, args.idle_timeout, args.retries, args.retry_delay, metrics)
+
+	jobs = JobScheduler(ParsePriorities(args.priority), args.max_wait)
+	ready = None
+	pending = EventCoalescer(args.debounce, lambda path: remote.DirExists(path) or any(remote.FileExists(variant) for variant in Variants(path)))
+
+	# List the whole remote tree once
+	remote = RemoteIndex()
+	with pool.Connection() as ftp:
+		remote.Build(ftp, parsed.path)
+
+	if args.plan:
+		Plan([DirectoryHandler(source, parsed.path) for source in args.source])
+		pool.CloseAll()
+		manifest.Close()
+		journal.Close()
+		sys.exit(0)
+
+	# Artifacts are only staged on disk for mirrors and the split compress/upload paths
+	cache = ArtifactCache(args.cache_dir, EncodeFile) if args.mirror or args.pipeline or args.engine == "asyncio" else None
+	mirrors = [Mirror(destination, args.mirror_threads, cache, metrics, PrettyPrint, args.idle_timeout, args.retries, args.retry_delay,
+		args.dry_run, Throttled) for destination in args.mirror]
+
+	# Start worker threads, they pick up jobs while the scan is still running
+	if args.engine == "asyncio":
+		engine_thread = threading.Thread(target=asyncio.run, args=(AsyncEngine(args.connections or 16, args.threads),))
+		engine_thread.daemon = True
+		engine_thread.start()
+	else:
+		for i in range(args.threads):
+			worker_thread = threading.Thread(target=Worker)
+			worker_thread.daemon = True
+			worker_thread.start()
+
+	# Upload stage, fed with ready artifacts by the workers
+	if args.pipeline:
+		ready = queue.Queue(maxsize=args.ready_queue)
+		for i in range(args.upload_threads or args.connections or args.threads):
+			upload_thread = threading.Thread(target=Uploader)
+			upload_thread.daemon = True
+			upload_thread.start()
+
+	# Work left over from the last run goes first
+	replayed = jobs.Replay()
+	if replayed:
+		print("Replaying {0} jobs from the journal".format(replayed))
+		metrics.Count("replayed_jobs", replayed)
+
+	if args.reverse or args.verify:
+		handlers = [DirectoryHandler(source, parsed.path) for source in args.source]
+		if args.verify:
+			Verify(handlers)
+		else:
+			Reverse(handlers)
+		jobs.join()
+		if ready:
+			ready.join()
+		for mirror in mirrors:
+			mirror.Jobs.join()
+		if cache:
+			cache.Close()
+		pool.CloseAll()
+		manifest.Close()
+		journal.Close()
+		sys.exit(0)
+
+	# Create initial jobs. Failed watches are reported and retried by the
+	# reconciler, pyinotify would log every directory on every attempt.
+	pyinotify.log.setLevel("CRITICAL")
 	WatchManager = pyinotify.WatchManager()
 	DirectoryHandlers = []
 	for source in args.source:
 		handler = DirectoryHandler(source, parsed.path, WatchManager)
 		DirectoryHandlers.append(handler)
-		handler.Do(ftp)
-
-	ftp.quit()
-
-	# Start worker threads
-	for i in range(args.threads):
-		worker_thread = threading.Thread(target=Worker)
-		worker_thread.daemon = True
-		worker_thread.start()
+	reconciler = Reconciler(DirectoryHandlers, args.reconcile_interval, args.watch_retry)
+	if not args.no_scan:
+		Scan(DirectoryHandlers)
 
-	# inotify loop
+	# inotify loop, one notifier serves all sources, every watch carries its own handler
+	Notifier = pyinotify.Notifier(WatchManager, OverflowHandler())
+	signal.signal(signal.SIGTERM, Terminate)
 	try:
 		while True:
-			for handler in DirectoryHandlers:
-				handler.Loop()
+			EventLoop(Notifier)
+			pool.Reap()
 	except KeyboardInterrupt:
 		print("Waiting for remaining jobs to complete...")
+		pending.Flush(force=True)
 		jobs.join()
+		if ready:
+			ready.join()
+		for mirror in mirrors:
+			mirror.Jobs.join()
+		if cache:
+			cache.Close()
+		pool.CloseAll()
+		manifest.Close()
+		journal.Close()
 		print("Exiting!")
+	except Checkpoint:
+		# Queued and running jobs are in the journal already, write out the
+		# held back ones too and leave without waiting. The next start
+		# picks them up where this one stopped.
+		pending.Flush(force=True)
+		print("Checkpointed {0} jobs, exiting!".format(journal.Count()))
+		sys.stdout.flush()
+		os._exit(0)
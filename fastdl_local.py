@@ -2,17 +2,37 @@
 import argparse
 import sys
 import os
-import math
 import time
 import threading
 import queue
 import bz2
 import shutil
+import collections
+import heapq
+import contextlib
+import concurrent.futures
 import pyinotify
+import sqlite3
+import hashlib
 import traceback
+import subprocess
+import signal
+import json
+import http.server
+from fastdl_common import FileHash, Variants, ArtifactCache, Mirror
 
 global args
 global jobs
+global journal
+global levels
+global metrics
+global pending
+global reconciler
+global block_pool
+global cpu
+global manifest
+global mirrors
+global cache
 
 # Terminal color codes
 c_null	= "\x1b[00;00m"
@@ -42,67 +62,579 @@ ignore_names = ["cs_assault.bsp", "cs_compound.bsp", "cs_havana.bsp",
 # inotify mask
 NOTIFY_MASK = pyinotify.IN_CLOSE_WRITE | pyinotify.IN_DELETE | pyinotify.IN_MOVED_TO | pyinotify.IN_MOVED_FROM
 
-def RemoveEmptyFolders(path):
-	if not os.path.isdir(path):
+# Jobs the startup scan would queue again
+COMPRESS_JOBS = ("Compress", "CompressMirrors")
+
+# bzip2 block size at compresslevel 9
+BZ2_BLOCK_SIZE = 900*1000
+
+def PrintStatus(filename, status, color):
+	# ioctl instead of forking stty per file, falls back to 80 columns without a TTY
+	columns = shutil.get_terminal_size().columns
+	rows = -(-(len(filename) + len(status))//columns)
+	text = filename + ' '*(columns*rows - (len(filename) + len(status))) + color + status + c_null
+	text += chr(8)*(len(text) + 1)
+	print(text + '\n'*rows)
+
+# Log callback handed to the mirrors
+def PrintMirror(name, status):
+	if args.verbose:
+		PrintStatus(name, status, c_red if status == "Deleted" else c_green)
+
+# Bottom-up removal of the given directories and the parents they leave
+# empty, deepest first, never touching root. No directory listings needed,
+# removing a non-empty directory simply fails.
+def PruneEmptyFolders(directories, root):
+	root = os.path.abspath(root)
+	heap = [(-d.count(os.sep), d) for d in set(directories)]
+	heapq.heapify(heap)
+	seen = set(directories)
+	while heap:
+		depth, directory = heapq.heappop(heap)
+		if not directory.startswith(root + os.sep):
+			continue
+		try:
+			os.rmdir(directory)
+		except OSError:
+			continue # not empty or already gone
+
+		parent = os.path.dirname(directory)
+		if parent not in seen:
+			seen.add(parent)
+			heapq.heappush(heap, (-parent.count(os.sep), parent))
+
+# Histogram bucket bounds per metric
+METRIC_BUCKETS = {
+	"compress_mbps": (1, 2, 5, 10, 20, 50, 100, 200),
+	"upload_mbps": (0.5, 1, 2, 5, 10, 20, 50, 100),
+	"compression_ratio": (0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0),
+	"publish_latency_seconds": (0.5, 1, 2, 5, 10, 30, 60, 300, 900),
+}
+
+class Metrics:
+	def __init__(self):
+		self.Lock = threading.Lock()
+		self.Start = time.monotonic()
+		self.Counters = collections.Counter()
+		self.Gauges = {}
+		self.Histograms = {} # name -> [bucket counts, count, sum]
+		self.EventTimes = {} # destination path -> time of first unpublished event
+		self.LastReport = self.Start
+
+	def Count(self, name, value=1):
+		with self.Lock:
+			self.Counters[name] += value
+
+	def Set(self, name, value):
+		with self.Lock:
+			self.Gauges[name] = value
+
+	def Observe(self, name, value):
+		bounds = METRIC_BUCKETS[name]
+		with self.Lock:
+			histogram = self.Histograms.setdefault(name, [[0]*len(bounds), 0, 0])
+			for i, bound in enumerate(bounds):
+				if value <= bound:
+					histogram[0][i] += 1
+			histogram[1] += 1
+			histogram[2] += value
+
+	def Mean(self, name):
+		histogram = self.Histograms.get(name)
+		if not histogram or not histogram[1]:
+			return 0
+		return histogram[2]/histogram[1]
+
+	def EventSeen(self, path):
+		with self.Lock:
+			self.EventTimes.setdefault(path, time.monotonic())
+
+	def Forget(self, path):
+		with self.Lock:
+			self.EventTimes.pop(path, None)
+
+	def Published(self, path):
+		with self.Lock:
+			seen = self.EventTimes.pop(path, None)
+		if seen is not None:
+			self.Observe("publish_latency_seconds", time.monotonic() - seen)
+
+	def Snapshot(self):
+		self.Set("queue_depth", jobs.qsize())
+		with self.Lock:
+			return {
+				"uptime_seconds": time.monotonic() - self.Start,
+				"counters": dict(self.Counters),
+				"gauges": dict(self.Gauges),
+				"histograms": dict((name, {"buckets": dict(zip(METRIC_BUCKETS[name], h[0])), "count": h[1], "sum": h[2]}) for name, h in self.Histograms.items()),
+			}
+
+	def Prometheus(self):
+		snapshot = self.Snapshot()
+		lines = []
+		for name, value in sorted(snapshot["counters"].items()):
+			lines.append("# TYPE fastdl_{0}_total counter".format(name))
+			lines.append("fastdl_{0}_total {1}".format(name, value))
+		for name, value in sorted(snapshot["gauges"].items()):
+			lines.append("# TYPE fastdl_{0} gauge".format(name))
+			lines.append("fastdl_{0} {1}".format(name, value))
+		for name, histogram in sorted(snapshot["histograms"].items()):
+			lines.append("# TYPE fastdl_{0} histogram".format(name))
+			for bound, count in histogram["buckets"].items():
+				lines.append("fastdl_{0}_bucket{{le=\"{1}\"}} {2}".format(name, bound, count))
+			lines.append("fastdl_{0}_bucket{{le=\"+Inf\"}} {1}".format(name, histogram["count"]))
+			lines.append("fastdl_{0}_count {1}".format(name, histogram["count"]))
+			lines.append("fastdl_{0}_sum {1}".format(name, histogram["sum"]))
+		return "\n".join(lines) + "\n"
+
+	def Summary(self):
+		with self.Lock:
+			counters = dict(self.Counters)
+			text = "[stats] queue {0} | scanned {1} | compressed {2} ({3:.1f} MB, {4:.1f} MB/s, ratio {5:.2f})".format(
+				jobs.qsize(), counters.get("scanned_files", 0), counters.get("compressed_files", 0),
+				counters.get("compressed_bytes_in", 0)/1024/1024, self.Mean("compress_mbps"),
+				counters.get("compressed_bytes_out", 0)/max(counters.get("compressed_bytes_in", 0), 1))
+			if counters.get("raw_files"):
+				text += " | raw {0} ({1:.0f}s CPU saved, {2:.1f} MB extra sent)".format(counters["raw_files"], counters.get("raw_cpu_seconds_saved", 0), counters.get("raw_extra_bytes", 0)/1024/1024)
+			if counters.get("cpu_throttle_seconds"):
+				text += " | throttled {0:.0f}s cpu".format(counters["cpu_throttle_seconds"])
+			text += " | latency {0:.1f}s | errors {1}".format(self.Mean("publish_latency_seconds"), counters.get("errors", 0))
+		return text
+
+	def Tick(self):
+		# Called from the main loop, reports every --stats-interval seconds
+		now = time.monotonic()
+		if now - self.LastReport < args.stats_interval:
+			return
+		self.LastReport = now
+
+		print(self.Summary())
+		if args.stats_file:
+			temp = args.stats_file + ".tmp"
+			with open(temp, "w") as f:
+				json.dump(self.Snapshot(), f, indent=1)
+			os.replace(temp, args.stats_file)
+
+	def Serve(self, address, port):
+		metrics = self
+		class Handler(http.server.BaseHTTPRequestHandler):
+			def do_GET(self):
+				body = metrics.Prometheus().encode()
+				self.send_response(200)
+				self.send_header("Content-Type", "text/plain; version=0.0.4")
+				self.send_header("Content-Length", str(len(body)))
+				self.end_headers()
+				self.wfile.write(body)
+
+			def log_message(self, format, *args):
+				pass
+
+		server = http.server.ThreadingHTTPServer((address, port), Handler)
+		thread = threading.Thread(target=server.serve_forever)
+		thread.daemon = True
+		thread.start()
+
+# Remembers size, mtime and content hash of every source file we compressed,
+# so startup only has to stat a file to know whether it changed.
+class Manifest:
+	def __init__(self, path):
+		self.Lock = threading.Lock()
+		self.Database = sqlite3.connect(path, check_same_thread=False)
+		self.Database.execute("PRAGMA journal_mode=WAL")
+		self.Database.execute("PRAGMA synchronous=NORMAL")
+		self.Database.execute("CREATE TABLE IF NOT EXISTS files (destfile TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, hash TEXT)")
+		self.Database.commit()
+
+		# Everything is kept in memory, the database is only written through
+		self.Entries = {}
+		for destfile, size, mtime, digest in self.Database.execute("SELECT destfile, size, mtime, hash FROM files"):
+			self.Entries[destfile] = (size, mtime, digest)
+
+	def Lookup(self, destfile):
+		return self.Entries.get(destfile)
+
+	def Unchanged(self, sourcefile, destfile, stat=None):
+		entry = self.Entries.get(destfile)
+		if entry is None:
+			return False
+
+		if stat is None:
+			stat = os.stat(sourcefile)
+		size, mtime, digest = entry
+		if size != stat.st_size:
+			return False
+		if mtime == stat.st_mtime_ns:
+			return True
+
+		# Touched but maybe not modified, compare content
+		if digest is not None and digest == FileHash(sourcefile):
+			self.Update(destfile, stat.st_size, stat.st_mtime_ns, digest)
+			return True
+		return False
+
+	def Update(self, destfile, size, mtime, digest):
+		with self.Lock:
+			self.Entries[destfile] = (size, mtime, digest)
+			self.Database.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)", (destfile, size, mtime, digest))
+			self.Database.commit()
+
+	def Remove(self, path):
+		# path may be a file or a whole directory
+		prefix = path.rstrip("/") + "/"
+		with self.Lock:
+			for destfile in [f for f in self.Entries if f == path or f.startswith(prefix)]:
+				del self.Entries[destfile]
+			self.Database.execute("DELETE FROM files WHERE destfile = ? OR substr(destfile, 1, ?) = ?", (path, len(prefix), prefix))
+			self.Database.commit()
+
+	def Below(self, path):
+		prefix = path.rstrip("/") + "/"
+		with self.Lock:
+			return [f for f in self.Entries if f.startswith(prefix)]
+
+	def Move(self, sourcepath, destpath):
+		prefix = sourcepath.rstrip("/") + "/"
+		with self.Lock:
+			for destfile in [f for f in self.Entries if f == sourcepath or f.startswith(prefix)]:
+				self.Entries[destpath + destfile[len(sourcepath):]] = self.Entries.pop(destfile)
+			self.Database.execute("UPDATE OR REPLACE files SET destfile = ? || substr(destfile, ?) WHERE destfile = ? OR substr(destfile, 1, ?) = ?",
+				(destpath, len(sourcepath) + 1, sourcepath, len(prefix), prefix))
+			self.Database.commit()
+
+	def Close(self):
+		with self.Lock:
+			self.Database.close()
+
+# Write-ahead log of the job queue, kept next to the manifest. Jobs are written
+# before they are queued and removed when done, whatever is left at startup
+# (crash, kill or checkpoint) is queued again. Every row carries the
+# destination it was written for, daemons sharing a manifest only replay their own.
+class Journal:
+	def __init__(self, path, destination):
+		self.Destination = destination
+		self.Lock = threading.Lock()
+		self.Database = sqlite3.connect(path, check_same_thread=False)
+		self.Database.execute("PRAGMA journal_mode=WAL")
+		self.Database.execute("PRAGMA synchronous=NORMAL")
+		self.Database.execute("CREATE TABLE IF NOT EXISTS journal (id INTEGER PRIMARY KEY, job TEXT, destination TEXT)")
+		if "destination" not in [column[1] for column in self.Database.execute("PRAGMA table_info(journal)")]:
+			# Journal from an older version, its rows go to the first daemon that starts
+			self.Database.execute("ALTER TABLE journal ADD COLUMN destination TEXT")
+		self.Database.execute("UPDATE journal SET destination = ? WHERE destination IS NULL", (destination,))
+		self.Database.commit()
+
+		self.Rows = {} # id(job) -> row, while the job is queued or running
+		self.Replayed = set() # destinations of replayed compress jobs, the startup scan leaves them alone
+
+	def Add(self, job):
+		data = json.dumps([job[0].__name__] + list(job[1:]))
+		with self.Lock:
+			self.Rows[id(job)] = self.Database.execute("INSERT INTO journal (job, destination) VALUES (?, ?)", (data, self.Destination)).lastrowid
+			self.Database.commit()
+
+	def Done(self, job):
+		with self.Lock:
+			row = self.Rows.pop(id(job), None)
+			if row is not None:
+				self.Database.execute("DELETE FROM journal WHERE id = ?", (row,))
+				self.Database.commit()
+
+	def Load(self):
+		loaded = []
+		with self.Lock:
+			for row, data in self.Database.execute("SELECT id, job FROM journal WHERE destination = ? ORDER BY id", (self.Destination,)).fetchall():
+				name, *params = json.loads(data)
+				job = (globals()[name],) + tuple(tuple(p) if isinstance(p, list) else p for p in params)
+				if name in COMPRESS_JOBS:
+					self.Replayed.add(job[-1])
+				self.Rows[id(job)] = row
+				loaded.append(job)
+		return loaded
+
+	def Count(self):
+		with self.Lock:
+			return self.Database.execute("SELECT COUNT(*) FROM journal WHERE destination = ?", (self.Destination,)).fetchone()[0]
+
+	def Close(self):
+		with self.Lock:
+			self.Database.close()
+
+# Limits how many threads compress at the same time and holds compression
+# back while the load average is above max_load, so the game servers on
+# the same box keep their tick rate.
+class CPUBudget:
+	def __init__(self, slots, max_load):
+		self.Slots = threading.BoundedSemaphore(slots)
+		self.MaxLoad = max_load
+
+	@contextlib.contextmanager
+	def Slot(self):
+		start = time.perf_counter()
+		while self.MaxLoad and os.getloadavg()[0] > self.MaxLoad:
+			time.sleep(1)
+		self.Slots.acquire()
+		waited = time.perf_counter() - start
+		if waited > 0.001:
+			metrics.Count("cpu_throttle_seconds", waited)
+		try:
+			yield
+		finally:
+			self.Slots.release()
+
+def LowerPriority(nice, idle_io):
+	# Called before any thread is started, new threads inherit both
+	if nice:
+		os.nice(nice)
+	if idle_io:
+		try:
+			subprocess.run(["ionice", "-c", "3", "-p", str(os.getpid())], check=True)
+		except (OSError, subprocess.CalledProcessError):
+			print("Couldn't set idle I/O priority, is ionice installed?")
+
+def TimedCompress(block, level):
+	with cpu.Slot():
+		start = time.perf_counter()
+		data = bz2.compress(block, level)
+	return data, time.perf_counter() - start
+
+# pbzip2 style: every block becomes its own bz2 stream, compressed in parallel.
+# bzip2 and Python read the concatenated streams as one file, but decoders that
+# stop at the first end of stream only see the first block, hence opt-in.
+def CompressBlocks(infile, digest, level):
+	start = time.perf_counter()
+	size = 0
+	outsize = 0
+	cputime = 0
+	pending = collections.deque()
+	for block in iter(lambda: infile.read(BZ2_BLOCK_SIZE), b""):
+		digest.update(block)
+		size += len(block)
+		pending.append(block_pool.submit(TimedCompress, block, level))
+
+		# Bound memory to a few blocks per compression thread
+		while len(pending) > 2*args.compress_threads:
+			data, elapsed = pending.popleft().result()
+			cputime += elapsed
+			outsize += len(data)
+			yield data
+
+	while pending:
+		data, elapsed = pending.popleft().result()
+		cputime += elapsed
+		outsize += len(data)
+		yield data
+
+	# Sum of per-block times is what the single stream would have taken
+	walltime = time.perf_counter() - start
+	CompressStats(size, outsize, walltime)
+	if args.verbose:
+		print("Compressed {0} in {1:.1f}s ({2:.1f} MB/s, {3:.1f}x speedup over single stream)".format(infile.name, walltime, size/walltime/1024/1024, cputime/walltime))
+
+def CompressStats(size, outsize, elapsed):
+	metrics.Count("compressed_files")
+	metrics.Count("compressed_bytes_in", size)
+	metrics.Count("compressed_bytes_out", outsize)
+	if size:
+		metrics.Observe("compression_ratio", outsize/size)
+	if elapsed > 0:
+		metrics.Observe("compress_mbps", size/elapsed/1024/1024)
+
+def CompressChunks(infile, digest, level=9):
+	if args.parallel_threshold is not None and os.fstat(infile.fileno()).st_size >= args.parallel_threshold*1024*1024:
+		yield from CompressBlocks(infile, digest, level)
 		return
 
-	# remove empty subfolders
-	files = os.listdir(path)
-	if len(files):
-		for f in files:
-			fullpath = os.path.join(path, f)
-			if os.path.isdir(fullpath):
-				RemoveEmptyFolders(fullpath)
+	# Time spent suspended in yield belongs to the consumer, not to compression
+	size = 0
+	outsize = 0
+	elapsed = 0
+	start = time.perf_counter()
+	compressor = bz2.BZ2Compressor(level)
+	for chunk in iter(lambda: infile.read(64*1024), b""):
+		digest.update(chunk)
+		size += len(chunk)
+		with cpu.Slot():
+			data = compressor.compress(chunk)
+		if data:
+			outsize += len(data)
+			elapsed += time.perf_counter() - start
+			yield data
+			start = time.perf_counter()
+
+	data = compressor.flush()
+	outsize += len(data)
+	CompressStats(size, outsize, elapsed + time.perf_counter() - start)
+	yield data
+
+def CompressionLevel(sourcefile):
+	# Extension rules beat directory rules beat the default
+	level = levels.get("default", 9)
+	for part in os.path.dirname(sourcefile).split(os.sep):
+		level = levels.get(part, level)
+	return levels.get(os.path.splitext(sourcefile)[1], level)
+
+def ParseLevels(items):
+	levels = {}
+	for item in items:
+		name, _, value = item.partition("=")
+		levels[name] = int(value)
+	return levels
+
+# Returns (level, compressed data or None). Level 0 means publish the raw file,
+# either because a rule says so or because the sample from the start of the
+# file barely shrinks. Files that fit into the sample are not compressed twice.
+def ChoosePolicy(infile):
+	size = os.fstat(infile.fileno()).st_size
+	level = CompressionLevel(infile.name)
+	if level:
+		sample = infile.read(int(args.sample_size*1024*1024))
+		infile.seek(0)
+		if not sample:
+			return level, None
+
+		start = time.perf_counter()
+		with cpu.Slot():
+			compressed = bz2.compress(sample, level)
+		elapsed = time.perf_counter() - start
+		ratio = len(compressed)/len(sample)
+		if ratio <= args.max_ratio:
+			if len(sample) < size:
+				return level, None
+			CompressStats(size, len(compressed), elapsed)
+			return level, compressed
+
+		# Estimate what compressing the whole file would have cost and saved
+		metrics.Count("raw_cpu_seconds_saved", elapsed*size/len(sample))
+		metrics.Count("raw_extra_bytes", max(0, int(size*(1 - ratio))))
+
+	metrics.Count("raw_files")
+	metrics.Count("raw_bytes", size)
+	return 0, None
+
+def EncodeChunks(infile, digest, level, compressed=None):
+	if not level:
+		for chunk in iter(lambda: infile.read(64*1024), b""):
+			digest.update(chunk)
+			yield chunk
+	elif compressed is not None:
+		digest.update(infile.read())
+		yield compressed
+	else:
+		yield from CompressChunks(infile, digest, level)
 
-	# if folder empty, delete it
-	files = os.listdir(path)
-	if len(files) == 0:
-		os.rmdir(path)
+def EncodeFile(sourcefile, outfile):
+	# A source file as it gets published, for the artifact cache. Returns the level.
+	with open(sourcefile, "rb") as infile:
+		level, compressed = ChoosePolicy(infile)
+		for data in EncodeChunks(infile, hashlib.blake2b(digest_size=20), level, compressed):
+			outfile.write(data)
+	return level
 
 def Compress(item):
 	sourcefile, destfile = item
-	# Remove destination file if already exists
-	if os.path.exists(destfile):
-		os.remove(destfile)
-
-	# Check whether directory tree exists at destination, create it if necessary
-	directory = os.path.dirname(destfile)
-	if not os.path.exists(directory):
-		os.makedirs(directory)
 
+	digest = hashlib.blake2b(digest_size=20)
 	with open(sourcefile, "rb") as infile:
-		with bz2.BZ2File(destfile, "wb", compresslevel=9) as outfile:
-			shutil.copyfileobj(infile, outfile, 64*1024)
+		stat = os.fstat(infile.fileno())
+		level, compressed = ChoosePolicy(infile)
+		target = destfile if level else destfile[:-4] # Source clients fall back to the raw file
+
+		# Remove destination file if already exists, in either form
+		for path in Variants(destfile):
+			if os.path.exists(path):
+				os.remove(path)
+
+		# Check whether directory tree exists at destination, create it if necessary
+		directory = os.path.dirname(destfile)
+		if not os.path.exists(directory):
+			os.makedirs(directory)
+
+		# Written under a temporary name, a crash never leaves a truncated file
+		with open(target + ".tmp", "wb") as outfile:
+			for data in EncodeChunks(infile, digest, level, compressed):
+				outfile.write(data)
+		os.replace(target + ".tmp", target)
+
+	manifest.Update(destfile, stat.st_size, stat.st_mtime_ns, digest.hexdigest())
+
+	if mirrors:
+		# The published file is the artifact, mirrors don't compress again
+		artifact = cache.Copy(target, digest.hexdigest(), len(mirrors), CompressionLevel(sourcefile), level)
+		for mirror in mirrors:
+			mirror.Put(mirror.Publish, artifact, os.path.relpath(target, destination))
 
 	if args.verbose:
-		print("Compressed: {0}".format(sourcefile))
+		if level:
+			print("Compressed: {0}".format(sourcefile))
+		else:
+			print("Published raw: {0}".format(sourcefile))
 
-def Delete(item):
-	item = item[0]
-	if os.path.isdir(item):
-		shutil.rmtree(item)
-		if args.verbose:
-			print("Deleted directory: {0}".format(item))
+def CompressMirrors(item):
+	# Destination is up to date, publish to the mirrors that lack the file
+	sourcefile, destfile = item
+	relpath = os.path.relpath(destfile, destination)
+	missing = [mirror for mirror in mirrors if not mirror.Exists(relpath)]
+	if not missing:
 		return
 
-	if os.path.exists(item):
-		os.remove(item)
-		if args.verbose:
-			print("Deleted file: {0}".format(item))
+	published = [path for path in Variants(destfile) if os.path.isfile(path)]
+	if published:
+		# Copied from the destination, in the form it was published there
+		entry = manifest.Lookup(destfile)
+		digest = entry[2] if entry and entry[2] else FileHash(sourcefile)
+		policy = CompressionLevel(sourcefile)
+		level = policy if published[0] == destfile else 0
+		artifact = cache.Copy(published[0], digest, len(missing), policy, level)
+		relpath = os.path.relpath(published[0], destination)
+	else:
+		artifact, level = cache.Build(sourcefile, len(missing), CompressionLevel(sourcefile))
+		relpath = relpath if level else relpath[:-4]
+	for mirror in missing:
+		mirror.Put(mirror.Publish, artifact, relpath)
 
-	# Delte directory if empty
-	directory = os.path.dirname(item)
-	RemoveEmptyFolders(directory)
+def Delete(item):
+	DeleteBatch(([item[0]],))
+
+def DeleteBatch(item):
+	# Several deletes, then one prune of the directories they touched
+	directories = [os.path.dirname(os.path.abspath(path)) for path in item[0]]
+	for path in item[0]:
+		manifest.Remove(path)
+		if os.path.isdir(path):
+			if mirrors:
+				# FTP mirrors delete file by file and prune the directories afterwards
+				directories.extend(dirpath for dirpath, dirnames, filenames in os.walk(path))
+			shutil.rmtree(path)
+			if args.verbose:
+				print("Deleted directory: {0}".format(path))
+			continue
+
+		for variant in Variants(path):
+			if os.path.exists(variant):
+				os.remove(variant)
+				if args.verbose:
+					print("Deleted file: {0}".format(variant))
+
+	PruneEmptyFolders(directories, args.destination)
+	for mirror in mirrors:
+		mirror.Put(mirror.DeleteBatch, [os.path.relpath(path, destination) for path in item[0]], [os.path.relpath(d, destination) for d in directories])
 
 def Move(item):
 	sourcepath, destpath = item
 
+	for mirror in mirrors:
+		mirror.Put(mirror.Move, os.path.relpath(sourcepath, destination), os.path.relpath(destpath, destination))
+	manifest.Move(sourcepath, destpath)
 	if os.path.isdir(sourcepath):
 		shutil.move(sourcepath, destpath)
 		if args.verbose:
 			print("Moved directory: {0} to {1}".format(os.path.basename(sourcepath), os.path.basename(destpath)))
 		return
 
+	if not os.path.exists(sourcepath) and sourcepath.endswith(".bz2"):
+		# Published raw
+		sourcepath, destpath = sourcepath[:-4], destpath[:-4]
+
 	# Check whether directory tree exists at destination, create it if necessary
 	directory = os.path.dirname(destpath)
 	if not os.path.exists(directory):
@@ -113,48 +645,475 @@ def Move(item):
 	if args.verbose:
 		print("Moved file: {0} to {1}".format(os.path.basename(sourcepath), os.path.basename(destpath)))
 
+# Drop-in replacement for queue.Queue. Deletes and moves go first, then
+# compress jobs by priority class (maps first by default) and smallest file
+# first within a class. Jobs waiting longer than max_wait jump the line.
+class JobScheduler(queue.Queue):
+	def __init__(self, priorities, max_wait):
+		self.Priorities = priorities # extension or directory name -> priority class
+		self.MaxWait = max_wait
+		queue.Queue.__init__(self)
+
+	def put(self, job, block=True, timeout=None):
+		# Written ahead, so queued work survives a crash
+		journal.Add(job)
+		queue.Queue.put(self, job, block, timeout)
+
+	def Replay(self):
+		# Jobs left over from the last run, they are in the journal already
+		replayed = journal.Load()
+		for job in replayed:
+			queue.Queue.put(self, job)
+		return len(replayed)
+
+	def Done(self, job):
+		# Called once per job when it's finished, whoever finished it
+		journal.Done(job)
+		with self.mutex:
+			for path in self.Paths(job):
+				self.Running[path] -= 1
+				if not self.Running[path]:
+					del self.Running[path]
+
+	def Pending(self, path):
+		# A job on path is queued or running
+		with self.mutex:
+			return path in self.Queued or path in self.Running
+
+	def _init(self, maxsize):
+		self.Heap = []
+		self.Arrival = collections.deque()
+		self.Count = 0
+		self.Sequence = 0
+		self.Queued = {} # destination path -> entries not handed out yet
+		self.Below = {} # directory -> paths in Queued anywhere below it
+		self.Running = collections.Counter() # destination path -> jobs handed out, not done yet
+
+	def _qsize(self):
+		return self.Count
+
+	def Priority(self, job):
+		if job[0] is not Compress and job[0] is not CompressMirrors:
+			return 0, 0
+
+		sourcefile = job[1]
+		priority = self.Priorities.get("default", 3)
+		for part in os.path.dirname(sourcefile).split(os.sep):
+			priority = self.Priorities.get(part, priority)
+		priority = self.Priorities.get(os.path.splitext(sourcefile)[1], priority)
+
+		try:
+			size = os.path.getsize(sourcefile)
+		except OSError:
+			size = 0
+		return priority, size
+
+	def Paths(self, job):
+		# Destination paths a job works on
+		if job[0] is DeleteBatch:
+			return job[1]
+		if job[0] is Move:
+			return job[1:3]
+		return job[-1:]
+
+	def Ancestors(self, path):
+		parent = os.path.dirname(path)
+		while parent not in ("", "/"):
+			yield parent
+			parent = os.path.dirname(parent)
+
+	def Conflicts(self, job):
+		# Queued jobs on the same path, a directory above it or, for moves
+		# and deletes, anything below it. Index lookups only, the queue
+		# mutex is held.
+		for path in self.Paths(job):
+			yield from self.Queued.get(path, ())
+			for parent in self.Ancestors(path):
+				yield from self.Queued.get(parent, ())
+			if job[0] is not Compress:
+				for key in self.Below.get(path, ()):
+					yield from self.Queued[key]
+
+	def _put(self, job):
+		# A job never overtakes an earlier one it depends on, it sorts right
+		# behind the last of them instead
+		priority = max([self.Priority(job)] + [entry[0] for entry in self.Conflicts(job)])
+		self.Sequence += 1
+		entry = [priority, self.Sequence, job, time.monotonic(), False]
+		heapq.heappush(self.Heap, entry)
+		self.Arrival.append(entry)
+		for path in self.Paths(job):
+			if path not in self.Queued:
+				self.Queued[path] = []
+				for parent in self.Ancestors(path):
+					self.Below.setdefault(parent, set()).add(path)
+			self.Queued[path].append(entry)
+		self.Count += 1
+
+	def _get(self):
+		# Drop entries already handed out through the other structure
+		while self.Arrival[0][4]:
+			self.Arrival.popleft()
+		while self.Heap[0][4]:
+			heapq.heappop(self.Heap)
+
+		# Starvation protection
+		if time.monotonic() - self.Arrival[0][3] > self.MaxWait:
+			entry = self.Arrival.popleft()
+		else:
+			entry = heapq.heappop(self.Heap)
+
+		entry[4] = True
+		self.Count -= 1
+		for path in self.Paths(entry[2]):
+			self.Running[path] += 1
+			self.Queued[path].remove(entry)
+			if not self.Queued[path]:
+				del self.Queued[path]
+				for parent in self.Ancestors(path):
+					self.Below[parent].discard(path)
+					if not self.Below[parent]:
+						del self.Below[parent]
+		return entry[2]
+
+def ParsePriorities(items):
+	# Deletes and moves are always class 0
+	priorities = {".bsp": 1, "default": 3}
+	for item in items:
+		name, _, value = item.partition("=")
+		priorities[name] = int(value)
+	return priorities
+
+# Walks all source trees in parallel with os.scandir, every directory is a
+# separate task. Yields (handler, dirpath, filename, stat) as soon as a
+# directory has been read, so jobs reach the workers while the scan goes on.
+# roots limits the walk to (handler, directory) subtrees.
+def ScanSources(handlers, threads, roots=None):
+	results = queue.Queue()
+	lock = threading.Lock()
+	outstanding = [0]
+	executor = concurrent.futures.ThreadPoolExecutor(max_workers=threads)
+
+	def Submit(handler, path):
+		with lock:
+			outstanding[0] += 1
+		executor.submit(ScanDirectory, handler, path)
+
+	def ScanDirectory(handler, path):
+		candidates = []
+		try:
+			with os.scandir(path) as entries:
+				for entry in entries:
+					try:
+						if entry.is_dir(follow_symlinks=False):
+							Submit(handler, entry.path)
+						elif entry.name.endswith(valid_extensions):
+							candidates.append((entry.name, entry.stat()))
+					except FileNotFoundError:
+						pass # removed between readdir and stat
+					except OSError as e:
+						# Only this entry, the rest of the directory still counts
+						print("scan error {0}".format(e))
+		except OSError as e:
+			print("scan error {0}".format(e))
+		finally:
+			candidates.sort()
+			results.put((handler, path, candidates))
+			with lock:
+				outstanding[0] -= 1
+				if outstanding[0] == 0:
+					results.put(None)
+
+	if roots is None:
+		roots = [(handler, handler.SourceDirectory) for handler in handlers]
+	if not roots:
+		return
+
+	# Count all roots up front, so the first finished tree can't end the scan
+	outstanding[0] = len(roots)
+	for handler, path in roots:
+		executor.submit(ScanDirectory, handler, path)
+
+	try:
+		for handler, dirpath, candidates in iter(results.get, None):
+			for filename, stat in candidates:
+				yield handler, dirpath, filename, stat
+	finally:
+		executor.shutdown(wait=False)
+
+def Scan(handlers): # Normal mode
+	start = time.monotonic()
+	for handler, dirpath, filename, stat in ScanSources(handlers, args.scan_threads):
+		handler.Checkfile(dirpath, filename, stat)
+		metrics.Count("scanned_files")
+		metrics.Tick()
+	metrics.Set("scan_seconds", time.monotonic() - start)
+
+def Estimate(item):
+	# Compresses the start of the file like ChoosePolicy does and scales the
+	# result to the whole file. Returns (level, output bytes, CPU seconds).
+	sourcefile, size = item
+	level = CompressionLevel(sourcefile)
+	if not level or not size:
+		return 0, size, 0
+	with open(sourcefile, "rb") as infile:
+		sample = infile.read(int(args.sample_size*1024*1024))
+	start = time.perf_counter()
+	with cpu.Slot():
+		compressed = bz2.compress(sample, level)
+	elapsed = time.perf_counter() - start
+	ratio = len(compressed)/len(sample)
+	if ratio > args.max_ratio:
+		return 0, size, elapsed # copied raw, the sample is all it costs
+	return level, int(size*ratio), elapsed*size/len(sample)
+
+def Plan(handlers): # Plan mode
+	# The whole diff between sources and destination and what syncing it
+	# would cost, printed as JSON. Nothing is queued or written.
+	index = set()
+	candidates = [] # (kind, sourcefile, destfile, size)
+	unchanged = 0
+	for handler, dirpath, filename, stat in ScanSources(handlers, args.scan_threads):
+		sourcefile = os.path.join(dirpath, filename)
+		destfile = handler.Destination(dirpath, filename)
+		index.add(os.path.relpath(sourcefile, os.path.join(handler.SourceDirectory, "..")))
+		if manifest.Lookup(destfile):
+			if manifest.Unchanged(sourcefile, destfile, stat):
+				unchanged += 1
+				continue
+			candidates.append(("changes", sourcefile, destfile, stat.st_size))
+		elif any(os.path.isfile(path) for path in Variants(destfile)):
+			unchanged += 1 # the next scan adopts it
+		else:
+			candidates.append(("adds", sourcefile, destfile, stat.st_size))
+
+	destination = os.path.abspath(args.destination)
+	deletes = [os.path.join(dirpath, filename) for dirpath, filename in WalkDestination(destination)
+		if Variants(os.path.relpath(os.path.join(dirpath, filename), destination))[-1] not in index]
+
+	# A new file with the content of a deleted one is a rename
+	gone = collections.defaultdict(list)
+	for path in deletes:
+		entry = manifest.Lookup(path if path.endswith(".bz2") else path + ".bz2")
+		if entry and entry[2]:
+			gone[entry[0], entry[2]].append(path)
+	sizes = set(size for size, digest in gone)
+	moves = []
+	for candidate in [c for c in candidates if c[0] == "adds" and c[3] in sizes]:
+		kind, sourcefile, destfile, size = candidate
+		matches = gone.get((size, FileHash(sourcefile)))
+		if matches:
+			path = matches.pop()
+			moves.append({"source": path, "destination": destfile if path.endswith(".bz2") else destfile[:-4]})
+			candidates.remove(candidate)
+			deletes.remove(path)
+
+	plan = {"adds": [], "changes": [], "deletes": [], "moves": moves, "unchanged": unchanged, "journaled_jobs": journal.Count()}
+	totals = collections.Counter()
+	with concurrent.futures.ThreadPoolExecutor(max_workers=args.compress_threads) as executor:
+		estimates = executor.map(Estimate, [(sourcefile, size) for kind, sourcefile, destfile, size in candidates])
+		for (kind, sourcefile, destfile, size), (level, outsize, cputime) in zip(candidates, estimates):
+			plan[kind].append({"source": sourcefile, "destination": destfile if level else destfile[:-4], "size": size,
+				"level": level, "compressed_bytes": outsize, "cpu_seconds": round(cputime, 3)})
+			totals["source_bytes"] += size
+			totals["compressed_bytes"] += outsize
+			totals["cpu_seconds"] += cputime
+	for path in deletes:
+		size = os.path.getsize(path)
+		plan["deletes"].append({"destination": path, "size": size})
+		totals["deleted_bytes"] += size
+
+	plan["totals"] = {
+		"files": len(candidates),
+		"source_bytes": totals["source_bytes"],
+		"compressed_bytes": totals["compressed_bytes"],
+		"deleted_bytes": totals["deleted_bytes"],
+		"cpu_seconds": round(totals["cpu_seconds"], 1),
+		"wall_seconds": round(totals["cpu_seconds"]/min(args.threads, os.cpu_count()), 1),
+		"threads": args.threads,
+	}
+	json.dump(plan, sys.stdout, indent=1)
+	print()
+
+def EventLoop(notifier):
+	# Wait for events no longer than until the next coalesced job is due
+	if notifier.check_events(timeout=pending.Timeout()):
+		notifier.read_events()
+		notifier.process_events()
+	pending.Flush()
+	reconciler.Tick()
+	metrics.Tick()
+
 def Worker():
 	while True:
 		job = jobs.get()
 		try:
 			job[0](job[1:])
+			metrics.Count(job[0].__name__.lower() + "_jobs")
+			for path in (job[1] if job[0] is DeleteBatch else job[-1:]):
+				metrics.Published(path)
 		except Exception as e:
+			metrics.Count("errors")
 			print("worker error {0}".format(e))
 			print(traceback.format_exc())
 		finally:
+			jobs.Done(job)
 			jobs.task_done()
 
+# Raised from the SIGTERM handler in the main thread
+class Checkpoint(Exception):
+	pass
+
+def Terminate(signum, frame):
+	raise Checkpoint()
+
+# Holds inotify jobs back for a quiet period, keyed on destination path, so
+# repeated writes, write+delete and write+rename collapse into one job.
+class EventCoalescer:
+	def __init__(self, delay, exists):
+		self.Delay = delay
+		self.Exists = exists # whether a destination path is already published
+		self.Lock = threading.Lock()
+		self.Pending = collections.OrderedDict() # destination path -> (job, due time)
+
+	def Schedule(self, key, job):
+		self.Pending.pop(key, None)
+		self.Pending[key] = (job, time.monotonic() + self.Delay)
+
+	def Subtree(self, path):
+		prefix = path + "/"
+		return [key for key in self.Pending if key.startswith(prefix)]
+
+	def Put(self, job, source=None):
+		metrics.EventSeen(job[-1])
+		with self.Lock:
+			if job[0] is Compress:
+				previous = self.Pending.get(job[2])
+				if previous and previous[0][0] is Move and previous[0][1] not in self.Pending and self.Exists(previous[0][1]):
+					# Renamed then rewritten, the old name won't be moved away anymore
+					self.Schedule(previous[0][1], (Delete, previous[0][1]))
+				self.Schedule(job[2], job)
+
+			elif job[0] is Delete:
+				destpath = job[1]
+				for key in self.Subtree(destpath):
+					del self.Pending[key]
+
+				previous = self.Pending.pop(destpath, None)
+				if previous and previous[0][0] is Compress and not self.Exists(destpath):
+					# Written and deleted again before it was ever published
+					metrics.Forget(destpath)
+					return
+				self.Schedule(destpath, job)
+
+			elif job[0] is Move:
+				sourcepath, destpath = job[1:]
+				self.Pending.pop(destpath, None)
+
+				# Directory rename, point pending jobs below it to the new location
+				if source and os.path.isdir(source[1]):
+					moved = [(key, self.Pending.pop(key)[0]) for key in self.Subtree(sourcepath)]
+					if self.Exists(sourcepath):
+						self.Schedule(destpath, job)
+					for key, pendingjob in moved:
+						newkey = destpath + key[len(sourcepath):]
+						if pendingjob[0] is Compress and pendingjob[1].startswith(source[0] + "/"):
+							pendingjob = (Compress, source[1] + pendingjob[1][len(source[0]):], newkey)
+						elif pendingjob[0] is Delete:
+							pendingjob = (Delete, newkey)
+						elif pendingjob[0] is Move and pendingjob[1].startswith(sourcepath + "/"):
+							# Runs after the directory move, so its source has moved too
+							pendingjob = (Move, destpath + pendingjob[1][len(sourcepath):], newkey)
+						self.Schedule(newkey, pendingjob)
+					return
+
+				previous = self.Pending.pop(sourcepath, None)
+				if previous and previous[0][0] is Compress and source:
+					# Written then renamed, compress once under the final name
+					if self.Exists(sourcepath):
+						self.Schedule(sourcepath, (Delete, sourcepath))
+					self.Schedule(destpath, (Compress, source[1], destpath))
+				elif previous and previous[0][0] is Move:
+					# Renamed twice, move straight to the final name
+					self.Schedule(destpath, (Move, previous[0][1], destpath))
+				else:
+					self.Schedule(destpath, job)
+
+	def Timeout(self):
+		# Milliseconds until the next pending job is due, capped at one second
+		with self.Lock:
+			if not self.Pending:
+				return 1000
+			due = next(iter(self.Pending.values()))[1]
+		return int(min(max(due - time.monotonic(), 0), 1)*1000)
+
+	def Flush(self, force=False):
+		now = time.monotonic()
+		deletes = []
+		with self.Lock:
+			while self.Pending:
+				key, (job, due) = next(iter(self.Pending.items()))
+				if due > now and not force:
+					break
+				del self.Pending[key]
+				if job[0] is Delete:
+					deletes.append(job[1])
+					if len(deletes) == args.batch_size:
+						self.PutDeletes(deletes)
+					continue
+				self.PutDeletes(deletes) # keep the order
+				jobs.put(job)
+			self.PutDeletes(deletes)
+
+	def PutDeletes(self, deletes):
+		# Deletes due together run as one batch, followed by a single prune
+		if len(deletes) == 1:
+			jobs.put((Delete, deletes[0]))
+		elif deletes:
+			jobs.put((DeleteBatch, tuple(deletes)))
+		del deletes[:]
+
 class EventHandler(pyinotify.ProcessEvent):
-	def my_init(self, source, destination):
+	def my_init(self, source, destination, watchmanager):
 		self.SourceDirectory = os.path.abspath(source)
 		self.DestinationDirectory = os.path.abspath(destination)
+		self.WatchManager = watchmanager
+
+	def process_IN_CREATE(self, event):
+		# auto_add asks for these. Whatever landed in a new directory before
+		# its watch was added went unnoticed.
+		if event.dir:
+			reconciler.Lost(event.pathname, self.WatchManager.get_wd(event.pathname) is None)
 
 	def process_IN_CLOSE_WRITE(self, event):
 		if not event.pathname.endswith(valid_extensions) or os.path.basename(event.pathname) in ignore_names:
 			return
 
 		destpath = os.path.join(self.DestinationDirectory, os.path.relpath(event.pathname, os.path.join(self.SourceDirectory, "..")))
-		jobs.put((Compress, event.pathname, destpath + ".bz2"))
+		pending.Put((Compress, event.pathname, destpath + ".bz2"))
 
 	def process_IN_DELETE(self, event):
 		destpath = os.path.join(self.DestinationDirectory, os.path.relpath(event.pathname, os.path.join(self.SourceDirectory, "..")))
 		if event.dir:
 			if os.path.exists(destpath):
-				jobs.put((Delete, destpath))
+				pending.Put((Delete, destpath))
 		else:
 			if not event.pathname.endswith(valid_extensions) or os.path.basename(event.pathname) in ignore_names:
 				return
 
-			jobs.put((Delete, destpath + ".bz2"))
+			pending.Put((Delete, destpath + ".bz2"))
 
 	def process_IN_MOVED_TO(self, event):
 		# Moved from untracked directory, handle as new file
 		if not hasattr(event, "src_pathname"):
+			if event.dir:
+				reconciler.Lost(event.pathname, self.WatchManager.get_wd(event.pathname) is None)
+				return
 			if not event.pathname.endswith(valid_extensions) or os.path.basename(event.pathname) in ignore_names:
 				return
 
 			destpath = os.path.join(self.DestinationDirectory, os.path.relpath(event.pathname, os.path.join(self.SourceDirectory, "..")))
-			jobs.put((Compress, event.pathname, destpath + ".bz2"))
+			pending.Put((Compress, event.pathname, destpath + ".bz2"))
 			return
 
 		# Moved inside tracked directory, handle as rename
@@ -162,22 +1121,22 @@ class EventHandler(pyinotify.ProcessEvent):
 		destpath = os.path.join(self.DestinationDirectory, os.path.relpath(event.pathname, os.path.join(self.SourceDirectory, "..")))
 
 		if event.dir:
-			jobs.put((Move, sourcepath, destpath))
+			pending.Put((Move, sourcepath, destpath), source=(event.src_pathname, event.pathname))
 		else:
 			if event.src_pathname.endswith(valid_extensions) in ignore_names or os.path.basename(event.pathname) in ignore_names:
 				return
 
 			if not event.src_pathname.endswith(valid_extensions) and event.pathname.endswith(valid_extensions):
 				# Renamed invalid_ext file to valid one -> compress
-				jobs.put((Compress, event.pathname, destpath + ".bz2"))
+				pending.Put((Compress, event.pathname, destpath + ".bz2"))
 				return
 
 			elif event.src_pathname.endswith(valid_extensions) and not event.pathname.endswith(valid_extensions):
 				# Renamed valid_ext file to invalid one -> delete from destination
-				jobs.put((Delete, sourcepath + ".bz2"))
+				pending.Put((Delete, sourcepath + ".bz2"))
 				return
 
-			jobs.put((Move, sourcepath + ".bz2", destpath + ".bz2"))
+			pending.Put((Move, sourcepath + ".bz2", destpath + ".bz2"), source=(event.src_pathname, event.pathname))
 
 class DirectoryHandler:
 	def __init__(self, source, destination, watchmanager=None):
@@ -196,59 +1155,192 @@ class DirectoryHandler:
 
 		if watchmanager:
 			self.WatchManager = watchmanager
-			self.NotifyHandler = EventHandler(source=self.SourceDirectory, destination=self.DestinationDirectory)
-			self.NotifyNotifier = pyinotify.Notifier(self.WatchManager, self.NotifyHandler, timeout=1000)
-			self.NotifyWatch = self.WatchManager.add_watch(self.SourceDirectory, NOTIFY_MASK, rec=True, auto_add=True)
+			self.NotifyHandler = EventHandler(source=self.SourceDirectory, destination=self.DestinationDirectory, watchmanager=watchmanager)
+			self.Unwatched = self.Watch(self.SourceDirectory)
+
+	def Watch(self, path):
+		# Returns the directories that couldn't be watched, fs.inotify.max_user_watches
+		# is the usual suspect. pyinotify only logs those.
+		result = self.WatchManager.add_watch(path, NOTIFY_MASK, proc_fun=self.NotifyHandler, rec=True, auto_add=True)
+		return [directory for directory, wd in result.items() if wd < 0]
 
 	def __enter__(self):
 		return self
 
 	def __exit__(self, type, value, traceback):
-		self.WatchManager.rm_watch(self.NotifyWatch, rec=True)
+		self.WatchManager.rm_watch(self.WatchManager.get_wd(self.SourceDirectory), rec=True)
 
-	def Loop(self):
-		self.NotifyNotifier.process_events()
-		while self.NotifyNotifier.check_events():
-			self.NotifyNotifier.read_events()
-			self.NotifyNotifier.process_events()
+	def DestinationDir(self, dirpath):
+		return os.path.join(self.DestinationDirectory, os.path.relpath(dirpath, os.path.join(self.SourceDirectory, "..")))
 
-	def Do(self): # Normal mode
-		for dirpath, dirnames, filenames in os.walk(self.SourceDirectory):
-			filenames.sort()
-			for filename in [f for f in filenames if f.endswith(valid_extensions)]:
-				self.Checkfile(dirpath, filename)
+	def Destination(self, dirpath, filename):
+		return os.path.join(self.DestinationDir(dirpath), filename + ".bz2")
 
-	def Checkfile(self, dirpath, filename):
+	def Checkfile(self, dirpath, filename, stat=None, reconcile=False):
+		# Reconciling, changes go through the coalescer and unchanged files aren't reported
 		sourcefile = os.path.join(dirpath, filename)
-		destfile = os.path.join(self.DestinationDirectory, os.path.relpath(dirpath, os.path.join(self.SourceDirectory, "..")), filename + ".bz2")
+		destfile = self.Destination(dirpath, filename)
+		if not reconcile and destfile in journal.Replayed:
+			return # the startup scan leaves jobs queued again from the journal alone
+		if reconcile and jobs.Pending(destfile):
+			return # no manifest entry until the queued or running job is done
 
-		exists = os.path.isfile(destfile)
+		if manifest.Lookup(destfile):
+			# Known file, a single stat tells whether it needs recompression
+			exists = manifest.Unchanged(sourcefile, destfile, stat)
+		else:
+			exists = any(os.path.isfile(path) for path in Variants(destfile))
+			if exists:
+				# Compressed before the manifest existed, adopt it
+				stat = stat or os.stat(sourcefile)
+				manifest.Update(destfile, stat.st_size, stat.st_mtime_ns, None)
 
-		if args.verbose:
+		if args.verbose and not (reconcile and exists):
 			if exists:
 				status = "Exists"
 				color = c_white
+			elif manifest.Lookup(destfile):
+				status = "Changed"
+				color = c_green
 			else:
 				status = "Added"
 				color = c_green
 
-			columns = int(os.popen("stty size", 'r').read().split()[1])
-			rows = math.ceil((len(filename) + len(status))/columns)
-			text = filename + ' '*(columns*rows - (len(filename) + len(status))) + color + status + c_null
-			text += chr(8)*(len(text) + 1)
-			print(text + '\n'*rows)
+			PrintStatus(filename, status, color)
 
 		if not exists:
-			jobs.put((Compress, sourcefile, destfile))
+			(pending.Put if reconcile else jobs.put)((Compress, sourcefile, destfile))
+		elif mirrors and not all(mirror.Exists(os.path.relpath(destfile, destination)) for mirror in mirrors):
+			# New or lagging mirror
+			jobs.put((CompressMirrors, sourcefile, destfile))
+
+# inotify drops events when its queue overflows and can't watch directories
+# past fs.inotify.max_user_watches. Subtrees affected by either are rescanned
+# in the background with the same stat-only check as the startup scan, and
+# unwatched ones keep being polled until a watch can be added. A periodic
+# pass over everything catches whatever slipped through anyway.
+class Reconciler:
+	def __init__(self, handlers, interval, retry_interval):
+		self.Handlers = handlers
+		self.Interval = interval
+		self.RetryInterval = retry_interval
+		self.Lock = threading.Lock()
+		self.Dirty = set() # source directories to rescan
+		self.Unwatched = set(path for handler in handlers for path in handler.Unwatched)
+		self.NextFull = time.monotonic() + interval if interval else None
+		self.NextRetry = time.monotonic() + retry_interval
+		self.Thread = None
+
+		if self.Unwatched:
+			print("{0} directories could not be watched (fs.inotify.max_user_watches?), polling them every {1}s".format(len(self.Unwatched), retry_interval))
+
+	def Handler(self, path):
+		for handler in self.Handlers:
+			if path == handler.SourceDirectory or path.startswith(handler.SourceDirectory + "/"):
+				return handler
+
+	def Lost(self, path, unwatched=False):
+		with self.Lock:
+			self.Dirty.add(path)
+			if unwatched and path not in self.Unwatched:
+				print("Can't watch {0} (fs.inotify.max_user_watches?), polling it every {1}s".format(path, self.RetryInterval))
+				self.Unwatched.add(path)
+				metrics.Count("unwatched_directories")
 
-def CheckfileReverse(dirpath, filename):
+	def Overflow(self):
+		# The kernel doesn't say which events were dropped
+		print("inotify queue overflowed, rescanning sources")
+		metrics.Count("inotify_overflows")
+		with self.Lock:
+			self.Dirty.update(handler.SourceDirectory for handler in self.Handlers)
+
+	def Tick(self):
+		# From the main loop, it owns the watch manager
+		now = time.monotonic()
+		if self.Unwatched and now >= self.NextRetry:
+			self.NextRetry = now + self.RetryInterval
+			with self.Lock:
+				unwatched = Outermost(self.Unwatched)
+				self.Unwatched = set()
+			for path in unwatched:
+				if os.path.isdir(path):
+					self.Lost(path)
+					failed = self.Handler(path).Watch(path)
+					with self.Lock:
+						self.Unwatched.update(failed)
+
+		if self.NextFull and now >= self.NextFull:
+			self.NextFull = now + self.Interval
+			with self.Lock:
+				self.Dirty.update(handler.SourceDirectory for handler in self.Handlers)
+
+		if not self.Dirty or (self.Thread and self.Thread.is_alive()):
+			return
+		with self.Lock:
+			roots = [(self.Handler(path), path) for path in Outermost(self.Dirty) if os.path.isdir(path)]
+			self.Dirty = set()
+		self.Thread = threading.Thread(target=self.Rescan, args=(roots,))
+		self.Thread.daemon = True
+		self.Thread.start()
+
+	def Rescan(self, roots):
+		# Jobs go through the coalescer, a file still being written gets one
+		# job once it's done, whether the scan or inotify saw it first
+		start = time.monotonic()
+		seen = set()
+		for handler, dirpath, filename, stat in ScanSources(self.Handlers, args.scan_threads, roots):
+			handler.Checkfile(dirpath, filename, stat, reconcile=True)
+			seen.add(handler.Destination(dirpath, filename))
+			metrics.Count("rescanned_files")
+
+		# Compressed files whose source is gone, their delete events were lost
+		for handler, path in roots:
+			for destfile in manifest.Below(handler.DestinationDir(path)):
+				sourcefile = os.path.join(handler.SourceDirectory, "..", os.path.relpath(destfile[:-4], handler.DestinationDirectory))
+				if destfile not in seen and not os.path.exists(sourcefile):
+					pending.Put((Delete, destfile))
+		metrics.Set("rescan_seconds", time.monotonic() - start)
+
+def Outermost(paths):
+	# Drops every path that lies below another one
+	result = []
+	for path in sorted(paths, key=lambda path: path.count("/")):
+		if not any(path.startswith(parent + "/") for parent in result):
+			result.append(path)
+	return result
+
+class OverflowHandler(pyinotify.ProcessEvent):
+	# Default handler of the notifier, IN_Q_OVERFLOW belongs to no watch
+	def process_IN_Q_OVERFLOW(self, event):
+		reconciler.Overflow()
+
+def SourceIndex(handlers):
+	# Paths relative to each source's parent, from one parallel scandir walk per source
+	index = set()
+	for handler, dirpath, filename, stat in ScanSources(handlers, args.scan_threads):
+		index.add(os.path.relpath(os.path.join(dirpath, filename), os.path.join(handler.SourceDirectory, "..")))
+	return index
+
+def WalkDestination(root):
+	pending = [root]
+	while pending:
+		path = pending.pop()
+		filenames = []
+		with os.scandir(path) as entries:
+			for entry in entries:
+				if entry.is_dir(follow_symlinks=False):
+					pending.append(entry.path)
+				elif entry.name.endswith(".bz2"):
+					filenames.append(entry.name)
+				elif entry.name.endswith(valid_extensions) and manifest.Lookup(entry.path + ".bz2"):
+					# A raw file is only ours when the manifest published it, anything else was put there by hand
+					filenames.append(entry.name)
+		for filename in sorted(filenames):
+			yield path, filename
+
+def CheckfileReverse(dirpath, filename, index):
 	destfile = os.path.join(dirpath, filename)
-	exists = False
-	for source in args.source:
-		sourcefile = os.path.join(source, "..", os.path.relpath(dirpath, args.destination), filename[:-4]) # Remove last 4 characters -> ".bz2"
-		if os.path.isfile(sourcefile):
-			exists = True
-			break
+	exists = Variants(os.path.relpath(destfile, args.destination))[-1] in index # Compressed or raw
 
 	if args.verbose:
 		if exists:
@@ -258,24 +1350,50 @@ def CheckfileReverse(dirpath, filename):
 			status = "Added"
 			color = c_red
 
-		columns = int(os.popen("stty size", 'r').read().split()[1])
-		rows = math.ceil((len(filename) + len(status))/columns)
-		text = filename + ' '*(columns*rows - (len(filename) + len(status))) + color + status + c_null
-		text += chr(8)*(len(text) + 1)
-		print(text + '\n'*rows)
+		PrintStatus(filename, status, color)
 
-	if not exists:
-		jobs.put((Delete, destfile))
+	return not exists
 
 if __name__ == "__main__":
 	parser = argparse.ArgumentParser(description="Automate FastDL BZip2 process")
 	parser.add_argument("-v", "--verbose", action="store_true", help="Turn on verbose (debugging) output")
 	parser.add_argument("-t", "--threads", type=int, default=1, help="Worker thread count")
 	parser.add_argument("-r", "--reverse", action="store_true", help="Reverse mode. Walks through destination and checks if source exists. Deletes file if not found in source.")
+	parser.add_argument("--plan", action="store_true", help="Plan mode. Prints the changes a sync would make and estimates of its size and CPU time as JSON, then exits")
+	parser.add_argument("--batch-size", type=int, default=100, help="Number of deletes run as one job before the empty directories get pruned")
+	parser.add_argument("--manifest", default=None, help="Sync manifest database (default: ~/.fastdl_manifest_<destination>.sqlite)")
+	parser.add_argument("--compress-threads", type=int, default=os.cpu_count(), help="Threads used to compress large files block-parallel")
+	parser.add_argument("--parallel-threshold", type=int, default=None, help="Compress files of at least this many MB block-parallel. Off by default: the result is a series of bzip2 streams, decoders that stop at the first end of stream (Source clients may be among them) only get the first 900 kB")
+	parser.add_argument("--max-compress", type=int, default=os.cpu_count(), help="Most threads compressing at the same time, across all jobs")
+	parser.add_argument("--max-load", type=float, default=None, help="Pause compression while the 1 minute load average is above this")
+	parser.add_argument("--nice", type=int, default=0, help="Raise the niceness of the whole process by this much")
+	parser.add_argument("--idle-io", action="store_true", help="Run with idle I/O priority (ionice -c 3)")
+	parser.add_argument("--debounce", type=float, default=2.0, help="Seconds a file has to stay quiet before its changes are synced")
+	parser.add_argument("--priority", action="append", default=[], metavar="NAME=CLASS", help="Compress priority class for an extension (.mdl) or directory name (materials), lower runs first. Defaults: .bsp=1, default=3")
+	parser.add_argument("--max-wait", type=float, default=60, help="Jobs waiting longer than this many seconds run next regardless of priority")
+	parser.add_argument("--no-scan", action="store_true", help="Skip the startup scan, only replay the journal. For restarts when the sources didn't change meanwhile")
+	parser.add_argument("--scan-threads", type=int, default=8, help="Threads used to walk the source trees at startup")
+	parser.add_argument("--reconcile-interval", type=float, default=3600, help="Rescan the sources every this many seconds for changes inotify missed, 0 disables. Overflows and failed watches trigger a rescan of their own")
+	parser.add_argument("--watch-retry", type=float, default=60, help="Seconds between attempts to watch directories that hit fs.inotify.max_user_watches, they are polled meanwhile")
+	parser.add_argument("--stats-interval", type=float, default=60, help="Print a statistics summary every this many seconds")
+	parser.add_argument("--stats-file", default=None, help="Write statistics as JSON to this file every --stats-interval")
+	parser.add_argument("--metrics-port", type=int, default=None, help="Serve Prometheus metrics over HTTP on this port")
+	parser.add_argument("--metrics-address", default="127.0.0.1", help="Address the metrics endpoint listens on, 0.0.0.0 for all interfaces")
+	parser.add_argument("--level", action="append", default=[], metavar="NAME=LEVEL", help="bzip2 level for an extension (.mp3) or directory name (sound), 0 publishes the raw file. Default: default=9")
+	parser.add_argument("--sample-size", type=float, default=1, help="MB from the start of each file used to estimate its compression ratio")
+	parser.add_argument("--max-ratio", type=float, default=0.95, help="Publish the raw file when the sample compresses worse than this ratio")
+	parser.add_argument("-m", "--mirror", action="append", default=[], help="Additional destination, local path or ftp:// URL. Files are compressed once and published to all")
+	parser.add_argument("--mirror-threads", type=int, default=2, help="Worker threads (and FTP connections) per mirror")
+	parser.add_argument("--cache-dir", default=os.path.expanduser("~/.fastdl_cache"), help="Compressed artifacts waiting for mirrors, every process uses its own subdirectory")
+	parser.add_argument("--idle-timeout", type=int, default=300, help="Close pooled FTP connections to mirrors idle for this many seconds")
+	parser.add_argument("--retries", type=int, default=5, help="Retries after a dropped connection to a mirror")
+	parser.add_argument("--retry-delay", type=float, default=1, help="Seconds before the first retry, doubled every time")
 	parser.add_argument("source", nargs='+', help="Source Path")
 	parser.add_argument("destination", help="Destination Path")
 	args = parser.parse_args()
 
+	LowerPriority(args.nice, args.idle_io)
+
 	# Check whether directory exists
 	if not os.path.isdir(args.destination):
 		print("Destination path ({0}) doesn't exist!", args.destination)
@@ -289,32 +1407,102 @@ if __name__ == "__main__":
 		print("Destination path ({0}) is not writeable! (Check permissions)", args.destination)
 		sys.exit(1)
 
-	jobs = queue.Queue()
+	# Kept outside the destination, it's a web root and the manifest lists source paths
+	destination = os.path.abspath(args.destination)
+	manifestpath = args.manifest or os.path.expanduser("~/.fastdl_manifest_{0}_{1}.sqlite".format(
+		os.path.basename(destination), hashlib.blake2b(destination.encode(), digest_size=4).hexdigest()))
+	oldpath = os.path.join(destination, ".fastdl_manifest.sqlite")
+	if not args.manifest and os.path.exists(oldpath) and not os.path.exists(manifestpath):
+		# Left there by an older version
+		for suffix in ("", "-wal", "-shm"):
+			if os.path.exists(oldpath + suffix):
+				shutil.move(oldpath + suffix, manifestpath + suffix)
+		print("Moved manifest out of the destination to {0}".format(manifestpath))
+	manifest = Manifest(manifestpath)
+	journal = Journal(manifestpath, destination)
+
+	block_pool = concurrent.futures.ThreadPoolExecutor(max_workers=args.compress_threads)
+	cpu = CPUBudget(args.max_compress, args.max_load)
+
+	levels = ParseLevels(args.level)
+
+	metrics = Metrics()
+	if args.metrics_port:
+		metrics.Serve(args.metrics_address, args.metrics_port)
+
+	if args.plan:
+		Plan([DirectoryHandler(source, args.destination) for source in args.source])
+		manifest.Close()
+		journal.Close()
+		sys.exit(0)
+
+	cache = ArtifactCache(args.cache_dir, EncodeFile) if args.mirror else None
+	mirrors = [Mirror(path, args.mirror_threads, cache, metrics, PrintMirror, args.idle_timeout, args.retries, args.retry_delay) for path in args.mirror]
+
+	jobs = JobScheduler(ParsePriorities(args.priority), args.max_wait)
+	pending = EventCoalescer(args.debounce, lambda path: any(os.path.exists(variant) for variant in Variants(path)))
 	for i in range(args.threads):
 		worker_thread = threading.Thread(target=Worker)
 		worker_thread.daemon = True
 		worker_thread.start()
 
+	# Work left over from the last run goes first
+	replayed = jobs.Replay()
+	if replayed:
+		print("Replaying {0} jobs from the journal".format(replayed))
+		metrics.Count("replayed_jobs", replayed)
+
 	if args.reverse:
-		for dirpath, dirnames, filenames in os.walk(args.destination):
-			filenames.sort()
-			for filename in [f for f in filenames if f.endswith(".bz2")]:
-				CheckfileReverse(dirpath, filename)
+		# Two tree walks, orphan detection is a set lookup
+		index = SourceIndex([DirectoryHandler(source, args.destination) for source in args.source])
+		orphans = [os.path.join(dirpath, filename) for dirpath, filename in WalkDestination(destination)
+			if CheckfileReverse(dirpath, filename, index)]
+		for i in range(0, len(orphans), args.batch_size):
+			jobs.put((DeleteBatch, tuple(orphans[i:i + args.batch_size])))
 		jobs.join()
+		for mirror in mirrors:
+			mirror.Jobs.join()
+		if cache:
+			cache.Close()
+		manifest.Close()
+		journal.Close()
 		sys.exit(0)
 	else:
+		# Failed watches are reported and retried by the reconciler,
+		# pyinotify would log every directory on every attempt
+		pyinotify.log.setLevel("CRITICAL")
 		WatchManager = pyinotify.WatchManager()
 		DirectoryHandlers = []
 		for source in args.source:
 			handler = DirectoryHandler(source, args.destination, WatchManager)
 			DirectoryHandlers.append(handler)
-			handler.Do()
+		reconciler = Reconciler(DirectoryHandlers, args.reconcile_interval, args.watch_retry)
+		if not args.no_scan:
+			Scan(DirectoryHandlers)
+
+		# One notifier serves all sources, every watch carries its own handler
+		Notifier = pyinotify.Notifier(WatchManager, OverflowHandler())
 
+	signal.signal(signal.SIGTERM, Terminate)
 	try:
 		while True:
-			for handler in DirectoryHandlers:
-				handler.Loop()
+			EventLoop(Notifier)
 	except KeyboardInterrupt:
 		print("Waiting for remaining jobs to complete...")
+		pending.Flush(force=True)
 		jobs.join()
+		for mirror in mirrors:
+			mirror.Jobs.join()
+		if cache:
+			cache.Close()
+		manifest.Close()
+		journal.Close()
 		print("Exiting!")
+	except Checkpoint:
+		# Queued and running jobs are in the journal already, write out the
+		# held back ones too and leave without waiting. The next start
+		# picks them up where this one stopped.
+		pending.Flush(force=True)
+		print("Checkpointed {0} jobs, exiting!".format(journal.Count()))
+		sys.stdout.flush()
+		os._exit(0)
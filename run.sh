@@ -3,3 +3,6 @@
 ./fastdl_ftp.py -t 2 ~/cstrike/{maps,materials,models,sound} ftp://fastdl.something.com/home/fastdl/public/cstrike
 # or
 # ./fastdl_local.py -t 2 ~/cstrike/{maps,materials,models,sound} /home/something.com/fastdl/public/cstrike
+
+# Benchmark on a synthetic tree (ftp part needs pyftpdlib), compare against an earlier run
+# ./benchmark.py -s 1 -t 2 -o results.json --compare baseline.json